@@ -1,80 +1,67 @@
 #%%
-import requests
 import pandas as pd
-from tqdm import tqdm
-from bs4 import BeautifulSoup
-import pickle
 
-# Read all Cochrane review ids
-id_version_list = pd.read_csv("data/25-04-01-citation-export-interventions-no-abstract.csv")["Cochrane Review ID"]
-#id_version_list = id_version_list.str.replace('PUB', 'pub')
+from functions import SofHtmlStore
+from fetch_functions import PageCache, SofTableStore, FetchTelemetry, CircuitBreaker, resolve_id_versions, retrieve_summary_of_findings_tables
 
-def retrieve_summary_of_findings_table(id, print_version_warning=False):
-    # URL of the Cochrane review
-    url = "https://www.cochranelibrary.com/cdsr/doi/10.1002/14651858." + id + "/full"
+# Number of parallel connections and requests per second to cochranelibrary.com
+max_concurrent = 8
+requests_per_second = 4
+# 429 / 5xx / connection errors are retried up to max_retries times (exponential backoff, honouring Retry-After),
+# the crawl pauses for cooldown seconds if more than half of the last 50 requests failed
+max_retries = 5
+circuit_breaker = CircuitBreaker(window=50, error_rate=0.5, cooldown=120)
 
-    # Set headers to mimic a browser request
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-    }
+# Raw pages are cached (and revalidated with ETag / Last-Modified), offline=True re-extracts the SoF tables from the cache without any requests
+page_cache = PageCache("data/page-cache", max_bytes=20 * 1024**3)
+offline = False
 
-    # Fetch the page content
-    response = requests.get(url, headers=headers)
+# Read all Cochrane review ids
+id_version_list = pd.read_csv("data/25-04-01-citation-export-interventions-no-abstract.csv")["Cochrane Review ID"]
+#id_version_list = id_version_list.str.replace('PUB', 'pub')
 
-    # Check if the request was successful
-    if response.status_code == 200:
-        page_content = response.content
+# Every fetched review is committed to the store immediately, so an interrupted run resumes where it stopped
+sof_tables = SofTableStore("data/25-04-01-sof-tables-interventions.sqlite")
+if not len(sof_tables):
+    sof_tables.import_pickle("data/25-01-19-sof-tables-all.pickle")
 
-        # Parse the page content using BeautifulSoup
-        soup = BeautifulSoup(page_content, 'html.parser')
+# "csv" or "parquet" (typed columnar tables, needs pyarrow) for the outputs of all pipeline stages
+table_format = "csv"
 
-        # Check whether the page was locked
-        unlock_full_review = soup.find('a', {'text': 'Unlock the full review'})
-        if unlock_full_review:
-            print(f"Lock Warning: This review is locked. ID: {id}")
+# Older versions of a review are only fetched on demand (e.g. fetch_older_versions_of = ["CD000329"]), 404s and pages without SoF table are re-checked after negative_cache_ttl
+fetch_older_versions_of = []
+negative_cache_ttl = 90 * 24 * 3600
 
-        if print_version_warning:
-            version_warning = soup.find('p', {'class': 'version-warning'})
-            if version_warning:
-                print(f"Verion Warning: This review was retracted or is not the most recent version. ID: {id}")
 
-        # Find the "Summary of findings" table(s) (without the section-parent, tables would be duplicated because of "Figures and Tables" section at the bottom of the page)
-        summary_table = soup.select('section.summaryOfFindings table.summary-of-findings')
+#%%
+id_versions_to_fetch = resolve_id_versions(id_version_list, sof_tables, fetch_older_versions_of, negative_cache_ttl)
 
-        if summary_table:
-            # Convert to string to reduce memory
-            return str(summary_table)
-        else:
-            #print(f"Summary of findings table not found. ID: {id}")
-            return None
-    else:
-        print(f"Failed to retrieve the page. ID: {id}. Status code: {response.status_code}")
-        return None
+telemetry = FetchTelemetry()
+retrieve_summary_of_findings_tables(id_versions_to_fetch, max_concurrent=max_concurrent, requests_per_second=requests_per_second, cache=page_cache, offline=offline, sof_tables=sof_tables, max_retries=max_retries, circuit_breaker=circuit_breaker, telemetry=telemetry)
+page_cache.close()
 
-with open("data/25-01-19-sof-tables-all.pickle", "rb") as file:
-    sof_tables = pickle.load(file)
+print(telemetry.report())
+with open('data/25-04-01-fetch-report.txt', 'w') as file:
+    file.write(telemetry.report())
 
-missing_id_version = id_version_list[~id_version_list.isin(list(sof_tables.keys()))].to_list()
+# Save as CSV / Parquet (sorted by id_version, streamed from the store)
+if table_format == "parquet":
+    sof_tables.to_parquet('data/25-04-01-sof-tables-interventions.parquet')
+else:
+    sof_tables.to_csv('data/25-04-01-sof-tables-interventions.csv')
 
+# Compressed per-review html for the parse stage and the manual checks dashboard (random access by cochrane_id)
+sof_html = SofHtmlStore('data/25-04-01-sof-html-interventions.sqlite')
+sof_html.update(sof_tables.items())
+sof_html.close()
+sof_tables.close()
 
 #%%
-for id_version in tqdm(missing_id_version):
-    id = id_version.split(".")[0]
-    if len(id_version.split(".")) > 1:
-        last_version = int(id_version[-1])
-    else:
-        last_version = 1
-    for version in range(last_version, 0, -1):
-        id_version = id
-        if version > 1:
-            id_version += f".PUB{version}"
-        if not id_version in sof_tables.keys():
-            sof_tables[id_version] = retrieve_summary_of_findings_table(id_version, print_version_warning=version==last_version)
+# Benchmark: SoF-section-only extraction vs. full-page BeautifulSoup parse on cached pages (also asserts identical output)
+#from fetch_functions import benchmark_summary_of_findings_extraction
+#benchmark_summary_of_findings_extraction(PageCache("data/page-cache"), n=200)
 
-with open('data/25-04-01-sof-tables-interventions.pickle', 'wb') as file:
-    pickle.dump(sof_tables, file)
-
-# Convert sof_tables to a pandas DataFrame and save as CSV
-sof_tables_df = pd.DataFrame.from_dict(sof_tables, orient='index', columns=['sof'])
-sof_tables_df = sof_tables_df.sort_index()
-sof_tables_df.to_csv('data/25-04-01-sof-tables-interventions.csv', index=True)
+#%%
+# Parity check: SoF-section-only extraction vs. full-page parse on all cached pages (should return an empty list)
+#from fetch_functions import check_summary_of_findings_extraction_parity
+#check_summary_of_findings_extraction_parity(PageCache("data/page-cache"))
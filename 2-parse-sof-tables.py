@@ -1,65 +1,30 @@
 #%%
-import re
-from tqdm import tqdm
+import os
 import pandas as pd
-from bs4 import BeautifulSoup
 
-from functions import table_merged_df, get_columns, extract_relative_effects_numbers_quality
+from functions import SofHtmlStore, ParseCache, parse_sof_tables, join_sof_tables, extract_relative_effects_numbers_quality, write_table
+
+# "csv" or "parquet" (typed columnar tables, needs pyarrow), same as in 1-get-sof-tables.py
+table_format = "csv"
+
+n_jobs = os.cpu_count()
+# Parsed fragments per review are cached, only reviews with changed SoF html (or after changes to the parser code) are parsed again
+parse_cache = ParseCache("results/parse-cache.sqlite")
 
 #%%
 cochrane_info = pd.read_csv("data/25-04-01-citation-export-interventions-no-abstract.csv")
 cochrane_info.index = cochrane_info["Cochrane Review ID"]
 
-sof_tables = pd.read_csv('data/25-04-01-sof-tables-interventions.csv', index_col=0)
-sof_tables = sof_tables[~sof_tables["sof"].isna()]
-sof_tables = sof_tables[sof_tables.index.isin(cochrane_info.index)]
-
-data = []
-
-for id in tqdm(sof_tables.index):
-    html_content = sof_tables.loc[id, 'sof']
-    # Replace non-breaking spaces for consistency (used inconsistently)
-    html_content = html_content.replace('\xa0', ' ')
-    # Replace all th with td for consistency (used inconsistently)
-    html_content = html_content.replace('<th', '<td')
-    html_content = html_content.replace('</th', '</td')
-    # Convert superscript digits
-    html_content = re.sub(r'(?<=<sup>)([\d,]+)(?=</sup>)', lambda m: ''.join(['⁰¹²³⁴⁵⁶⁷⁸⁹'[int(d)] if d.isdigit() else ' ' for d in m.group(0)]), html_content)
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # Loop over SOF-Tables to extract information
-    tables = soup.find_all('table', class_='summary-of-findings')
-    for table_nr in range(len(tables)):
-        table = tables[table_nr]
-
-        result_tuple = table_merged_df(table)
-        if not result_tuple:
-            continue
-        table_title, header_rows, footer_rows, table_df, merged_df = result_tuple
-
-        # Get columns
-        rownames_col, relative_effects_col, nr_participants_studies_col, certainty_col = get_columns(merged_df)
-
-        merged_df['NA'] = 'NA'
-        
-        # Only look at important columns
-        sof_df = merged_df[[rownames_col, relative_effects_col, nr_participants_studies_col, certainty_col]]
-        sof_df.columns = ['rowname', 'relative_effects', 'nr_participants_studies', 'certainty']
-        sof_df = sof_df.drop_duplicates() # Some rows are now duplicated, mostly because they used to have multiple sub-rows in "Illustrative comparative rates"
-
-        sof_df['cochrane_id'] = id
-        sof_df['table_nr'] = table_nr + 1
-        sof_df['table_title'] = table_title
-        sof_df['rownames_col'] = rownames_col
-        sof_df['relative_effects_col'] = relative_effects_col
-        sof_df['nr_participants_studies_col'] = nr_participants_studies_col
-        sof_df['certainty_col'] = certainty_col
-
-        sof_df['row_nr'] = list(range(1, sof_df.shape[0]+1))
-        
-        data = data + sof_df[['cochrane_id', 'table_nr', 'table_title', 'rownames_col', 'relative_effects_col', 'nr_participants_studies_col', 'certainty_col', 'row_nr', 'rowname', 'relative_effects', 'nr_participants_studies', 'certainty']].reset_index(drop=True).values.tolist()
-    
-combined_sof_df = pd.DataFrame(data, columns=['cochrane_id', 'table_nr', 'table_title', 'rownames_col', 'relative_effects_col', 'nr_participants_studies_col', 'certainty_col', 'row_nr', 'rowname', 'relative_effects', 'nr_participants_studies', 'certainty'])
+# Compressed SoF html written by 1-get-sof-tables.py (from an existing CSV / Parquet export: sof_html.import_table(f'data/25-04-01-sof-tables-interventions.{table_format}'))
+# Only reviews in cochrane_info, streamed chunk by chunk
+sof_html = SofHtmlStore('data/25-04-01-sof-html-interventions.sqlite')
+sof_tables = sof_html.subset(cochrane_info.index)
+
+# Reviews are parsed in n_jobs worker processes (n_jobs=1: serially), failing reviews are reported instead of aborting the run
+# Compact model: the table title and header columns once per table in sof_tables_df, combined_sof_df only has the outcome columns
+(sof_tables_df, combined_sof_df), parse_errors = parse_sof_tables(sof_tables, n_jobs=n_jobs, cache=parse_cache, compact=True)
+for id, error in parse_errors:
+    print(f"Parsing failed. ID: {id}. Error: {error}")
 
 # Remove obvious footer cell that accidentally got included in the table (probably bad colspan)
 combined_sof_df = combined_sof_df[~combined_sof_df["rowname"].str.lower().str.startswith("*the basis for the assumed risk", na=False)]
@@ -67,11 +32,14 @@ combined_sof_df = combined_sof_df[~combined_sof_df["rowname"].str.lower().str.st
 combined_sof_df = combined_sof_df[~combined_sof_df["rowname"].str.lower().str.startswith("grade working group", na=False)]
 combined_sof_df = combined_sof_df[~combined_sof_df["rowname"].str.lower().str.startswith("ci: confidence interval", na=False)]
 
-combined_sof_df.to_csv('results/25-04-01-combined_sof_df.csv', index=False)
+write_table(join_sof_tables(sof_tables_df, combined_sof_df), f'results/25-04-01-combined_sof_df.{table_format}', "combined_sof_df")
 # %%
-combined_sof_df = pd.read_csv("results/25-04-01-combined_sof_df.csv")
+# Continues with the compact model in memory (to resume from the written table instead: sof_tables_df, combined_sof_df = split_sof_tables(read_table(f"results/25-04-01-combined_sof_df.{table_format}")))
 
-parsed_sof_df = extract_relative_effects_numbers_quality(combined_sof_df)
+# use_re2: linear-time matching of the free-text cells (pip install google-re2); cells whose matching takes longer than cell_timeout seconds are reported and parsed as missing
+use_re2 = False
+cell_timeout = 5
+parsed_sof_df = extract_relative_effects_numbers_quality(combined_sof_df, use_re2=use_re2, cell_timeout=cell_timeout, sof_tables_df=sof_tables_df)
 
 # Remove ratio effects that are inconsistent (13 outcomes in 13 reviews)
 # list(zip(
@@ -197,7 +165,20 @@ temp = parsed_sof_df.loc[mask, "nr_participants_cleaned"].copy()
 parsed_sof_df.loc[mask, "nr_participants_cleaned"] = parsed_sof_df.loc[mask, "nr_studies_cleaned"]
 parsed_sof_df.loc[mask, "nr_studies_cleaned"] = temp
 
-parsed_sof_df = parsed_sof_df[['cochrane_id', 'table_nr', 'table_title', 'row_nr', 'rowname', 'effect_type', 'point_estimate', 'lower_ci', 'upper_ci', 'nr_participants_cleaned', 'nr_studies_cleaned', 'certainty_cleaned']]
-parsed_sof_df.to_csv("results/25-04-01-parsed_sof_df.csv", index=False)
+parsed_sof_df = join_sof_tables(sof_tables_df[['cochrane_id', 'table_nr', 'table_title']], parsed_sof_df, ['cochrane_id', 'table_nr', 'table_title', 'row_nr', 'rowname', 'effect_type', 'point_estimate', 'lower_ci', 'upper_ci', 'nr_participants_cleaned', 'nr_studies_cleaned', 'certainty_cleaned'])
+write_table(parsed_sof_df, f"results/25-04-01-parsed_sof_df.{table_format}", "parsed_sof_df")
 
-# %%
+#%%
+# Parity check: table grid builder vs. pd.read_html for every stored SoF table (should return an empty list)
+#from functions import check_table_merged_df_parity
+#check_table_merged_df_parity(sof_tables)
+
+#%%
+# Parity check: CSV vs. Parquet round trip of the outputs (should return empty lists, needs pyarrow)
+#from functions import check_table_format_parity
+#check_table_format_parity(join_sof_tables(sof_tables_df, combined_sof_df), "combined_sof_df"), check_table_format_parity(parsed_sof_df, "parsed_sof_df")
+
+#%%
+# Benchmark: single-pass nr_participants_studies normalization vs. the .str.replace chain (also asserts identical output)
+#from functions import benchmark_nr_participants_studies_normalization
+#benchmark_nr_participants_studies_normalization(combined_sof_df["nr_participants_studies"])
@@ -1,33 +1,43 @@
 #%%
 #import random
-import os
-import re
 import pandas as pd
 import streamlit as st
 from bs4 import BeautifulSoup
 import numpy as np
 import graphviz
 
+from functions import SofHtmlStore, ManualExtractionStore, read_table, write_table
+
 manual_extraction_path = "data/manual_extraction/"
+# "csv" or "parquet" (typed columnar tables, needs pyarrow), same as in 1-get-sof-tables.py and 2-parse-sof-tables.py
+table_format = "csv"
 
 st.set_page_config(page_title="Cochrane Summary of Findings (SOF) Tables", layout="wide")
 
-cochrane_ids_reviewed_included = np.array([re.sub(r"\.csv.*", "", x) for x in os.listdir(manual_extraction_path) if x.endswith(".csv")])
-cochrane_ids_reviewed_excluded = np.array([re.sub(r"\.csv.*", "", x) for x in os.listdir(f"{manual_extraction_path}excluded/")])
-cochrane_ids_reviewed_test = np.array([re.sub(r"\.csv.*", "", x) for x in os.listdir(f"{manual_extraction_path}test/")])
+@st.cache_resource
+def load_manual_extraction_store():
+    # All manual extraction CSVs in one indexed store
+    return ManualExtractionStore("data/manual_extraction.sqlite")
+
+manual_extraction_store = load_manual_extraction_store()
+# On every rerun: new or changed files are imported (unchanged ones only cost a stat call)
+imported, removed = manual_extraction_store.sync(manual_extraction_path)
+if imported or removed:
+    print(f"Manual extraction: {imported} files imported, {removed} removed")
 
 @st.cache_data
-def load_data():
+def load_data(manual_extraction_version):
+    # manual_extraction_version: reloaded whenever the manual extraction store changed
+    cochrane_ids_reviewed_included = manual_extraction_store.ids("included")
+    cochrane_ids_reviewed_excluded = manual_extraction_store.ids("excluded")
+    cochrane_ids_reviewed_test = manual_extraction_store.ids("test")
+
     cochrane_info = pd.read_csv("data/25-04-01-citation-export-interventions-no-abstract.csv")
     cochrane_info.index = cochrane_info["Cochrane Review ID"]
 
-    sof_original = pd.read_csv("data/25-04-01-sof-tables-interventions.csv", index_col=0)
-    sof_original = sof_original[~sof_original["sof"].isna()]
-    # Only keep reviews that are in cochrane_info, which contains only the newest reviews on interventions
-    sof_original = sof_original[sof_original.index.isin(cochrane_info.index)]
-    sof_original = sof_original.to_dict()["sof"]
-
-    parsed_sof_df = pd.read_csv("results/25-04-01-parsed_sof_df.csv")
+    parsed_sof_df = read_table(f"results/25-04-01-parsed_sof_df.{table_format}", columns=["cochrane_id", "table_nr", "row_nr", "rowname", "effect_type", "point_estimate", "lower_ci", "upper_ci", "nr_participants_cleaned", "nr_studies_cleaned", "certainty_cleaned"])
+    # Outcomes are compared with the manual extraction CSVs as strings, so use the CSV dtypes (no categoricals, counts as float)
+    parsed_sof_df = parsed_sof_df.astype({"cochrane_id": object, "effect_type": object, "certainty_cleaned": object, "nr_participants_cleaned": float, "nr_studies_cleaned": float})
     # Remove outcomes without GRADE
     parsed_sof_df = parsed_sof_df[parsed_sof_df["certainty_cleaned"].notna()]
 
@@ -37,16 +47,8 @@ def load_data():
     manual_sof_df_dict = {}
 
     for cochrane_id in np.concatenate((cochrane_ids_reviewed_included, cochrane_ids_reviewed_test)):
-        if os.path.exists(f"{manual_extraction_path}{cochrane_id}.csv"):
-            manual_sof_df = pd.read_csv(f"{manual_extraction_path}{cochrane_id}.csv").reset_index(drop=True)
-        else:
-            manual_sof_df = pd.read_csv(f"{manual_extraction_path}test/{cochrane_id}.csv").reset_index(drop=True)
-        
-        manual_sof_df["cochrane_id"] = cochrane_id
-
-        # row_nr missing in older manual_extraction files (not in test files though)
-        if not "row_nr" in manual_sof_df.columns:
-           manual_sof_df["row_nr"] = manual_sof_df.groupby("table_nr").cumcount() + 1
+        # Uniform columns (cochrane_id, row_nr added for older files) from the store
+        manual_sof_df = manual_extraction_store[cochrane_id]
 
         # Remove outcomes without GRADE 
         manual_sof_df = manual_sof_df[manual_sof_df["certainty_cleaned"].notna()]
@@ -86,9 +88,16 @@ def load_data():
     manual_extraction_per_table = pd.DataFrame(manual_extraction_per_table, columns=["cochrane_id", "table_nr", "fraction_length", "fraction_equal", "compare"])
     manual_extraction = manual_extraction_per_table.groupby("cochrane_id").agg({"fraction_length": "mean", "fraction_equal": "mean"})
 
-    return cochrane_info, sof_original, parsed_sof_df, manual_sof_df_dict, manual_extraction_per_table, manual_extraction
+    return cochrane_info, parsed_sof_df, manual_sof_df_dict, manual_extraction_per_table, manual_extraction, cochrane_ids_reviewed_included, cochrane_ids_reviewed_excluded, cochrane_ids_reviewed_test
+
+@st.cache_resource
+def load_sof_original(cochrane_ids):
+    # Compressed SoF html, only the html of the selected review is read and decompressed
+    # Only keep reviews that are in cochrane_info, which contains only the newest reviews on interventions
+    return SofHtmlStore("data/25-04-01-sof-html-interventions.sqlite").subset(cochrane_ids)
 
-cochrane_info, sof_original, parsed_sof_df, manual_sof_df_dict, manual_extraction_per_table, manual_extraction = load_data()
+cochrane_info, parsed_sof_df, manual_sof_df_dict, manual_extraction_per_table, manual_extraction, cochrane_ids_reviewed_included, cochrane_ids_reviewed_excluded, cochrane_ids_reviewed_test = load_data(manual_extraction_store.version())
+sof_original = load_sof_original(tuple(cochrane_info.index))
 
 #%%
 # Outcomes with certainty_cleaned non-nan must pass these unflagged_criteria:
@@ -140,12 +149,12 @@ final_sof_df["primary_outcome"] = False
 final_sof_df.loc[(final_sof_df["table_nr"] == 1) & (final_sof_df["row_nr"] == 1), "primary_outcome"] = True
 final_sof_df["mortality_outcome"] = final_sof_df["rowname"].astype(str).str.contains("mortality|death")
 
-final_sof_df[["cochrane_id", "table_nr", "effect_type", "point_estimate", "lower_ci", "upper_ci", "nr_participants_cleaned", "nr_studies_cleaned", "certainty_cleaned", "primary_outcome", "mortality_outcome"]].\
-    to_csv("final/25-04-01-final_sof_df.csv", index=False)
+write_table(final_sof_df[["cochrane_id", "table_nr", "effect_type", "point_estimate", "lower_ci", "upper_ci", "nr_participants_cleaned", "nr_studies_cleaned", "certainty_cleaned", "primary_outcome", "mortality_outcome"]],
+    f"final/25-04-01-final_sof_df.{table_format}", "final_sof_df")
 
 cochrane_ids_total_included = cochrane_info.index[cochrane_info.index.isin(final_sof_df["cochrane_id"].unique())]
-cochrane_info.loc[cochrane_ids_total_included, ["Cochrane Review ID", "Title", "Year", "Issue", "Keywords", "Cochrane Review Group Code"]].\
-    to_csv("final/25-04-01-final_cochrane_info.csv", index=False)
+write_table(cochrane_info.loc[cochrane_ids_total_included, ["Cochrane Review ID", "Title", "Year", "Issue", "Keywords", "Cochrane Review Group Code"]],
+    f"final/25-04-01-final_cochrane_info.{table_format}", "final_cochrane_info")
 
 #%%
 st.html("""
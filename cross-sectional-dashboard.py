@@ -3,15 +3,13 @@ import streamlit as st
 import numpy as np
 import pandas as pd
 
-from functions import create_box_pie_plot
+from functions import effect_size_cutoffs, add_outcome_flags, SortedOutcomeStats, render_box_pie_plot, read_table
 
-effect_size_cutoffs = {
-    "Very Large": 5,
-    "Large": 2,
-    "Medium": 1.5,
-    "Small": 1.2,
-    "Minimal": 1
-}
+# "csv" or "parquet" (typed columnar tables written by 3-manual-checks-dashboard.py, needs pyarrow)
+table_format = "csv"
+
+# GRADE certainty levels and their column name prefixes / suffixes in the per-review summary
+certainty_levels = {"very low": "very_low", "low": "low", "moderate": "moderate", "high": "high"}
 
 st.set_page_config(page_title="Cochrane Reviews", layout="wide")
 #st.set_page_config(page_title="Cochrane Reviews", layout="wide", initial_sidebar_state="auto", menu_items=None)
@@ -26,9 +24,29 @@ MainMenu, header, footer {visibility: hidden;}
 
 st.header("Cochrane Intervention Reviews with Summary of Findings (SoF) Tables")
 
+def normalize_keyword(keyword):
+    # Remove squared brackets and contents and asterisks from keywords
+    return keyword.split("[")[0].strip().strip("*").strip()
+
+def token_index(values, normalize=None):
+    # Inverted index: token -> sorted positions of the values whose "; "-separated list contains exactly this token (after normalize)
+    index = {}
+    for position, value in enumerate(values):
+        if isinstance(value, str):
+            for token in value.split("; "):
+                index.setdefault(normalize(token) if normalize else token, []).append(position)
+    return {token: np.unique(positions) for token, positions in index.items()}
+
+def token_mask(index, tokens, n):
+    # Positions containing any of the tokens (union of their index entries) as a boolean mask of length n
+    mask = np.zeros(n, dtype=bool)
+    for token in tokens:
+        mask[index.get(token, [])] = True
+    return mask
+
 @st.cache_data
 def get_cochrane_info_incl_topics():
-    cochrane_info = pd.read_csv("final/25-04-01-final_cochrane_info.csv", index_col=0)
+    cochrane_info = read_table(f"final/25-04-01-final_cochrane_info.{table_format}", columns=["Cochrane Review ID", "Title", "Year", "Issue", "Keywords", "Cochrane Review Group Code"], index_col=0)
     cochrane_info["URL"] = "http://dx.doi.org/10.1002/14651858." + cochrane_info.index
     
     review_groups = cochrane_info["Cochrane Review Group Code"].str.split("; ").to_list()
@@ -37,13 +55,14 @@ def get_cochrane_info_incl_topics():
 
     keywords = cochrane_info["Keywords"].str.split("; ").to_list()
     keywords = [keyword for sublist in keywords if isinstance(sublist, list) for keyword in sublist]
-    # Remove squared brackets and contents from keywords
-    keywords = [keyword.split("[")[0].strip() for keyword in keywords if isinstance(keyword, str)]
-    # Remove asterisks from keywords
-    keywords = [keyword.strip("*").strip() for keyword in keywords]
+    keywords = [normalize_keyword(keyword) for keyword in keywords if isinstance(keyword, str)]
 
     keywords = pd.Series(keywords).value_counts().to_dict()
 
+    # Exact-token filters for the sidebar selections (positions in cochrane_info)
+    review_group_index = token_index(cochrane_info["Cochrane Review Group Code"])
+    keyword_index = token_index(cochrane_info["Keywords"], normalize_keyword)
+
     # Add "Cochrane Topics" column to cochrane_info (Topics from https://www.cochranelibrary.com/cdsr/reviews)
     cochrane_info["Cochrane Topic"] = "no-topic"
 
@@ -65,37 +84,26 @@ def get_cochrane_info_incl_topics():
     # topics = pd.Series(topics).value_counts().to_dict()
     topics = {}
 
-    final_sof_df = pd.read_csv("final/25-04-01-final_sof_df.csv")
-
-    final_sof_df["has_relative_effect"] = final_sof_df["point_estimate"].notna()
-    final_sof_df["significant"] = (final_sof_df[["point_estimate", "lower_ci"]]>1).all(axis=1) | (final_sof_df[["point_estimate", "upper_ci"]]<1).all(axis=1)
-
-    # For dichotomous outcomes, in this case, one may consider rating down by two levels immediately if the ratio of the upper- to the lower-boundary of the CI is higher than 2.5 for odds ratios or 3.0 for relative risk ratios.
-    # https://usblog.gradeworkinggroup.org/2022/09/when-is-imprecision-very-serious-for.html
-    # Simulations conducted to inform GRADE guidance for addressing imprecision of dichotomous outcomes in the context of network meta-analysis provided insights into how many levels to rate down for imprecision in pairwise meta-analysis when considering the OIS [12]. These simulations suggested that when the ratio of the upper to the lower boundary of the CI is higher than 2.5 for odds ratios and three for RRs, the sample size is, for any reasonable combination of baseline risk and treatment effect, very far from meeting the OIS. Therefore, authors would not need to calculate the OIS and can rate down the certainty of evidence by two levels (Box 5, circumstance 1).
-    # Using the OIS approach, for dichotomous outcomes, one should consider rating down two levels for imprecision, when the ratio of the upper to the lower boundary of the CI is more than 2.5 for odds ratio or three for risk ratio;
-    # https://www.jclinepi.com/article/S0895-4356(22)00187-1/fulltext
-    # Unclear how to handle HR - handle like OR at the moment (i.e., cutoff 2.5)
-    final_sof_df["ci_very_wide"] = np.where(
-        final_sof_df["effect_type"] == "RR",
-        (final_sof_df["upper_ci"] / final_sof_df["lower_ci"]) > 3,
-        (final_sof_df["upper_ci"] / final_sof_df["lower_ci"]) > 2.5
-    )
+    final_sof_df = read_table(f"final/25-04-01-final_sof_df.{table_format}", columns=["cochrane_id", "table_nr", "effect_type", "point_estimate", "lower_ci", "upper_ci", "nr_participants_cleaned", "nr_studies_cleaned", "certainty_cleaned", "primary_outcome", "mortality_outcome"])
 
+    final_sof_df = add_outcome_flags(final_sof_df)
     effect_sizes = list(effect_size_cutoffs.keys())
-    for i in range(len(effect_sizes)):
-        effect_size = effect_sizes[i]
-        if i == 0:
-            final_sof_df[effect_size] = (final_sof_df["point_estimate"] >= effect_size_cutoffs[effect_size]) | (final_sof_df["point_estimate"] <= (1/effect_size_cutoffs[effect_size]))
-        else:
-            final_sof_df[effect_size] = ((final_sof_df["point_estimate"] >= effect_size_cutoffs[effect_size]) & (final_sof_df["point_estimate"] < effect_size_cutoffs[effect_sizes[i-1]])) | \
-                                            ((final_sof_df["point_estimate"] > (1/effect_size_cutoffs[effect_sizes[i-1]])) & (final_sof_df["point_estimate"] <= (1/effect_size_cutoffs[effect_size])))
-    
+
     #cochrane_info = cochrane_info[cochrane_info.index.isin(final_sof_df["cochrane_id"].unique())]
 
-    return cochrane_info, review_groups, topics, keywords, final_sof_df
+    # Outcome filters as one boolean array per predicate (combined in select_positions), and the position of each outcome's review in cochrane_info (-1: not in cochrane_info)
+    outcome_bitmaps = {column: final_sof_df[column].to_numpy(dtype=bool) for column in ["primary_outcome", "mortality_outcome", "has_relative_effect", "significant", "ci_very_wide", *effect_sizes]}
+    outcome_bitmaps.update({effect_type: (final_sof_df["effect_type"] == effect_type).to_numpy(dtype=bool, na_value=False) for effect_type in ["RR", "OR", "HR"]})
+    outcome_review_positions = cochrane_info.index.get_indexer(final_sof_df["cochrane_id"])
+    # Group key of the per-certainty summary: position in certainty_levels (-1: other or no rating)
+    outcome_certainty_codes = pd.Categorical(final_sof_df["certainty_cleaned"], categories=list(certainty_levels)).codes
+
+    # Box plot input of any outcome selection: outcomes per certainty level sorted by participants / studies once
+    outcome_sorted_stats = SortedOutcomeStats(final_sof_df)
 
-cochrane_info, review_groups, topics, keywords, final_sof_df = get_cochrane_info_incl_topics()
+    return cochrane_info, review_groups, topics, keywords, final_sof_df, review_group_index, keyword_index, outcome_bitmaps, outcome_review_positions, outcome_certainty_codes, outcome_sorted_stats
+
+cochrane_info, review_groups, topics, keywords, final_sof_df, review_group_index, keyword_index, outcome_bitmaps, outcome_review_positions, outcome_certainty_codes, outcome_sorted_stats = get_cochrane_info_incl_topics()
 
 cochrane_info["Year / Issue"] = cochrane_info["Year"].astype(str) + "/" + cochrane_info["Issue"].astype(str).str.zfill(2)
 
@@ -153,69 +161,86 @@ with st.sidebar:
 
 # Filter sof_dfs to match filtered reviews
 
-def get_filtered_data():
-    cochrane_info_sub = cochrane_info[(cochrane_info["Year"] >= year_range[0]) & (cochrane_info["Year"] <= year_range[1])]
+def any_bitmap(names):
+    # OR of the outcome_bitmaps of names (none selected: no outcome)
+    mask = np.zeros(len(outcome_review_positions), dtype=bool)
+    for name in names:
+        mask |= outcome_bitmaps[name]
+    return mask
+
+@st.cache_data(max_entries=1000)
+def select_positions(year_range, review_groups_sel, keywords_sel, primary_outcomes_sel, mortality_outcomes_sel, outcomes_with_ratio_sel, effect_types_sel, effect_sizes_sel, significant_sel, nonsignificant_sel, ci_not_very_wide_sel, ci_very_wide_sel):
+    # Positions of the selected reviews in cochrane_info and of their selected outcomes in final_sof_df, memoized per selection (shared by all sessions)
+    reviews_mask = ((cochrane_info["Year"] >= year_range[0]) & (cochrane_info["Year"] <= year_range[1])).to_numpy(dtype=bool, na_value=False)
 
     # if len(topics_sel):
     #     cochrane_info_sub = cochrane_info_sub[
     #         cochrane_info_sub["Cochrane Topic"].apply(lambda x: any(topic in x for topic in topics_sel))
     #     ]
 
+    # Reviews with any of the selected review groups / keywords (exact matches, e.g. "Child" does not select "Childbirth")
     if len(review_groups_sel):
-        cochrane_info_sub = cochrane_info_sub[
-            cochrane_info_sub["Cochrane Review Group Code"].apply(lambda x: any(review_group in x for review_group in review_groups_sel))
-        ]
+        reviews_mask &= token_mask(review_group_index, review_groups_sel, len(cochrane_info))
 
     if len(keywords_sel):
-        cochrane_info_sub = cochrane_info_sub[
-            cochrane_info_sub["Keywords"].apply(lambda x: isinstance(x, str) and any(keyword in x for keyword in keywords_sel))
-        ]
+        reviews_mask &= token_mask(keyword_index, keywords_sel, len(cochrane_info))
 
-    final_sof_df_sub = final_sof_df[final_sof_df["cochrane_id"].isin(cochrane_info_sub.index)]
+    outcomes_mask = (outcome_review_positions >= 0) & reviews_mask[outcome_review_positions]
 
     # These are AND connected
     if primary_outcomes_sel:
-        final_sof_df_sub = final_sof_df_sub[final_sof_df_sub["primary_outcome"]]
+        outcomes_mask &= outcome_bitmaps["primary_outcome"]
     if mortality_outcomes_sel:
-        final_sof_df_sub = final_sof_df_sub[final_sof_df_sub["mortality_outcome"]]
+        outcomes_mask &= outcome_bitmaps["mortality_outcome"]
     if outcomes_with_ratio_sel:
-        final_sof_df_sub = final_sof_df_sub[final_sof_df_sub["has_relative_effect"]]
+        outcomes_mask &= outcome_bitmaps["has_relative_effect"]
         # The following are OR connected
-        final_sof_df_sub = final_sof_df_sub[final_sof_df_sub["effect_type"].isin(pd.Series(effect_type_sel.keys())[effect_type_sel.values()])]
-        final_sof_df_sub = final_sof_df_sub[(significant_sel & final_sof_df_sub["significant"]) | (nonsignificant_sel & ~final_sof_df_sub["significant"])]
-        final_sof_df_sub = final_sof_df_sub[final_sof_df_sub[pd.Series(effect_size_sel.keys())[effect_size_sel.values()]].any(axis=1)]
-        final_sof_df_sub = final_sof_df_sub[(ci_very_wide_sel & final_sof_df_sub["ci_very_wide"]) | (ci_not_very_wide_sel & ~final_sof_df_sub["ci_very_wide"])]
-
-    cochrane_info_sub = cochrane_info_sub[cochrane_info_sub.index.isin(final_sof_df_sub["cochrane_id"].unique())]
-
-    cochrane_info_sub = pd.concat([
-        cochrane_info_sub,
-        final_sof_df_sub.groupby("cochrane_id").agg(
-            nr_outcomes = pd.NamedAgg("certainty_cleaned", "size"),
-            median_nr_participants = pd.NamedAgg("nr_participants_cleaned", "median"),
-            median_nr_studies = pd.NamedAgg("nr_studies_cleaned", "median"),
-        ),
-        final_sof_df_sub[final_sof_df_sub["certainty_cleaned"] == "very low"].groupby("cochrane_id").agg(
-            nr_outcomes_very_low = pd.NamedAgg("certainty_cleaned", "size"),
-            very_low_median_nr_participants = pd.NamedAgg("nr_participants_cleaned", "median"),
-            very_low_median_nr_studies = pd.NamedAgg("nr_studies_cleaned", "median"),
-        ),
-        final_sof_df_sub[final_sof_df_sub["certainty_cleaned"] == "low"].groupby("cochrane_id").agg(
-            nr_outcomes_low = pd.NamedAgg("certainty_cleaned", "size"),
-            low_median_nr_participants = pd.NamedAgg("nr_participants_cleaned", "median"),
-            low_median_nr_studies = pd.NamedAgg("nr_studies_cleaned", "median"),
-        ),
-        final_sof_df_sub[final_sof_df_sub["certainty_cleaned"] == "moderate"].groupby("cochrane_id").agg(
-            nr_outcomes_moderate = pd.NamedAgg("certainty_cleaned", "size"),
-            moderate_median_nr_participants = pd.NamedAgg("nr_participants_cleaned", "median"),
-            moderate_median_nr_studies = pd.NamedAgg("nr_studies_cleaned", "median"),
-        ),
-        final_sof_df_sub[final_sof_df_sub["certainty_cleaned"] == "high"].groupby("cochrane_id").agg(
-            nr_outcomes_high = pd.NamedAgg("certainty_cleaned", "size"),
-            high_median_nr_participants = pd.NamedAgg("nr_participants_cleaned", "median"),
-            high_median_nr_studies = pd.NamedAgg("nr_studies_cleaned", "median"),
-        )
-    ], axis=1)
+        outcomes_mask &= any_bitmap(effect_types_sel)
+        significant = outcome_bitmaps["significant"]
+        outcomes_mask &= (significant_sel & significant) | (nonsignificant_sel & ~significant)
+        outcomes_mask &= any_bitmap(effect_sizes_sel)
+        ci_very_wide = outcome_bitmaps["ci_very_wide"]
+        outcomes_mask &= (ci_very_wide_sel & ci_very_wide) | (ci_not_very_wide_sel & ~ci_very_wide)
+
+    # Only reviews with selected outcomes
+    reviews_mask &= np.bincount(outcome_review_positions[outcomes_mask], minlength=len(cochrane_info)) > 0
+
+    return np.flatnonzero(reviews_mask), np.flatnonzero(outcomes_mask)
+
+def get_filtered_data():
+    review_positions, outcome_positions = select_positions(
+        tuple(year_range), tuple(review_groups_sel), tuple(keywords_sel), primary_outcomes_sel, mortality_outcomes_sel, outcomes_with_ratio_sel,
+        tuple(name for name, sel in effect_type_sel.items() if sel), tuple(name for name, sel in effect_size_sel.items() if sel),
+        significant_sel, nonsignificant_sel, ci_not_very_wide_sel, ci_very_wide_sel
+    )
+    cochrane_info_sub = cochrane_info.iloc[review_positions]
+    final_sof_df_sub = final_sof_df.iloc[outcome_positions]
+
+    # Outcome counts and medians per review, in total and per certainty level: grouped by the precomputed integer keys
+    # (review position, certainty code), the levels in one groupby unstacked to one column per level
+    aggregations = dict(
+        nr_outcomes = pd.NamedAgg("certainty_cleaned", "size"),
+        median_nr_participants = pd.NamedAgg("nr_participants_cleaned", "median"),
+        median_nr_studies = pd.NamedAgg("nr_studies_cleaned", "median"),
+    )
+    review_keys = outcome_review_positions[outcome_positions]
+    certainty_keys = outcome_certainty_codes[outcome_positions]
+    rated = certainty_keys >= 0
+
+    per_review = final_sof_df_sub.groupby(review_keys).agg(**aggregations)
+    per_certainty = final_sof_df_sub[rated].groupby([review_keys[rated], certainty_keys[rated]]).agg(**aggregations).unstack()
+    suffixes = list(certainty_levels.values())
+    columns = [(aggregation, code) for code in range(len(suffixes)) for aggregation in aggregations]
+    per_certainty = per_certainty.reindex(columns=pd.MultiIndex.from_tuples(columns))
+    per_certainty.columns = [f"nr_outcomes_{suffixes[code]}" if aggregation == "nr_outcomes" else f"{suffixes[code]}_{aggregation}" for aggregation, code in columns]
+    for summary in (per_review, per_certainty):
+        summary.index = cochrane_info.index[summary.index].rename("cochrane_id")
+
+    cochrane_info_sub = pd.concat([cochrane_info_sub, per_review, per_certainty], axis=1)
+    # Counts stay integers if every review has outcomes of that level (as with one groupby per level)
+    for suffix in certainty_levels.values():
+        if cochrane_info_sub[f"nr_outcomes_{suffix}"].notna().all():
+            cochrane_info_sub[f"nr_outcomes_{suffix}"] = cochrane_info_sub[f"nr_outcomes_{suffix}"].astype("int64")
     cochrane_info_sub = cochrane_info_sub.rename(columns={
         "nr_outcomes": "# Outcomes",
         "nr_outcomes_very_low": "# Very Low Outcomes",
@@ -278,7 +303,9 @@ if len(cochrane_info_sub):
 
     with cols[1]:
         plot_df = final_sof_df_sub
-        fig_axes = create_box_pie_plot(plot_df)
-        #fig_axes[0].suptitle("All Outcomes")
-        #fig_axes[1].set_title(f"({plot_df.shape[0]} in {len(plot_df["cochrane_id"].unique())} Cochrane Reviews)")
-        st.pyplot(fig_axes[0], use_container_width=True)
\ No newline at end of file
+        # Exact statistics of the selected outcomes from the presorted outcomes (the selection as a mask over final_sof_df)
+        plot_mask = np.zeros(len(final_sof_df), dtype=bool)
+        plot_mask[final_sof_df.index.get_indexer(plot_df.index)] = True
+        stats = outcome_sorted_stats.stats(plot_mask)
+        # Rendered once per distinct statistics (LRU cache of the image bytes)
+        st.image(render_box_pie_plot(stats), use_container_width=True)
\ No newline at end of file
@@ -0,0 +1,537 @@
+#%%
+import os
+import re
+import gzip
+import time
+import random
+import sqlite3
+import asyncio
+import threading
+import hashlib
+import importlib.util
+from collections import Counter, deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import aiohttp
+import pandas as pd
+from tqdm import tqdm
+from bs4 import BeautifulSoup, UnicodeDammit
+
+cochrane_base_url = "https://www.cochranelibrary.com/cdsr/doi/10.1002/14651858."
+
+# br is only accepted if aiohttp can decode it (pip install Brotli), otherwise every br response fails with a ContentEncodingError
+brotli_available = any(importlib.util.find_spec(module) for module in ("brotli", "brotlicffi"))
+
+# Set headers to mimic a browser request
+headers = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3',
+    'Accept-Encoding': 'gzip, deflate, br' if brotli_available else 'gzip, deflate',
+}
+
+def review_url(id, base_url=cochrane_base_url):
+    return base_url + id + "/full"
+
+def extract_summary_of_findings_table_full_parse(id, page_content, print_version_warning=False):
+    # Parse the page content using BeautifulSoup
+    soup = BeautifulSoup(page_content, 'html.parser')
+
+    # Check whether the page was locked
+    unlock_full_review = soup.find('a', {'text': 'Unlock the full review'})
+    if unlock_full_review:
+        print(f"Lock Warning: This review is locked. ID: {id}")
+
+    if print_version_warning:
+        version_warning = soup.find('p', {'class': 'version-warning'})
+        if version_warning:
+            print(f"Verion Warning: This review was retracted or is not the most recent version. ID: {id}")
+
+    # Find the "Summary of findings" table(s) (without the section-parent, tables would be duplicated because of "Figures and Tables" section at the bottom of the page)
+    summary_table = soup.select('section.summaryOfFindings table.summary-of-findings')
+
+    if summary_table:
+        # Convert to string to reduce memory
+        return str(summary_table)
+    else:
+        #print(f"Summary of findings table not found. ID: {id}")
+        return None
+
+# Section tags, and the markup in which a "</section>" is no tag for the full parse (skipped): comments, script / style contents, attribute values of other tags
+section_tag_re = re.compile(r"""<!--.*?-->|<(script|style)\b.*?</\1\s*>|<(/?)section\b[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>|<[a-zA-Z][^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>""", re.IGNORECASE | re.DOTALL)
+sof_section_class_re = re.compile(r"""(?i:\bclass)\s*=\s*["']?[^"'>]*\bsummaryOfFindings\b""")
+# Start tags matched by soup.find('a', {'text': 'Unlock the full review'}) and soup.find('p', {'class': 'version-warning'})
+unlock_full_review_re = re.compile(r"""<a\b[^>]*\btext\s*=\s*(["'])Unlock the full review\1""", re.IGNORECASE)
+version_warning_re = re.compile(r"""<p\b[^>]*\bclass\s*=\s*["']?(?:[^"'>]*\s)?version-warning(?:[\s"'/>])""", re.IGNORECASE)
+
+def summary_of_findings_sections(page_text):
+    # Slices of the outermost <section> elements with class summaryOfFindings (incl. nested sections), or None if no such start tag is found
+    sections = []
+    start = None
+    depth = 0
+    for match in section_tag_re.finditer(page_text):
+        if match.group(2) is None:
+            continue
+        if start is None:
+            if not match.group(2) and sof_section_class_re.search(match.group(0)):
+                start = match.start()
+                depth = 1
+        elif match.group(2):
+            depth -= 1
+            if not depth:
+                sections.append(page_text[start:match.end()])
+                start = None
+        else:
+            depth += 1
+    if start is not None:
+        # Unclosed section: runs until the end of the page (as it would in the full parse)
+        sections.append(page_text[start:])
+    return sections or None
+
+def extract_summary_of_findings_table(id, page_content, print_version_warning=False):
+    # Same result as extract_summary_of_findings_table_full_parse, but only the summaryOfFindings sections are turned into a soup
+    # (the full review page is >1MB, the SoF sections usually a few kB)
+    page_text = UnicodeDammit(page_content, is_html=True).unicode_markup if isinstance(page_content, bytes) else page_content
+
+    # Check whether the page was locked
+    if unlock_full_review_re.search(page_text):
+        print(f"Lock Warning: This review is locked. ID: {id}")
+
+    if print_version_warning and version_warning_re.search(page_text):
+        print(f"Verion Warning: This review was retracted or is not the most recent version. ID: {id}")
+
+    if 'summaryOfFindings' not in page_text:
+        #print(f"Summary of findings table not found. ID: {id}")
+        return None
+
+    # Unusual markup where no section start tag is recognised: fall back to parsing the full page
+    sections = summary_of_findings_sections(page_text)
+    soup = BeautifulSoup(''.join(sections) if sections else page_text, 'html.parser')
+    summary_table = soup.select('section.summaryOfFindings table.summary-of-findings')
+    if sections and not summary_table and 'summary-of-findings' in page_text:
+        # Markup the section scanner misreads (no table within the slices, but the page has one): the full parse decides
+        summary_table = BeautifulSoup(page_text, 'html.parser').select('section.summaryOfFindings table.summary-of-findings')
+
+    if summary_table:
+        # Convert to string to reduce memory
+        return str(summary_table)
+    else:
+        return None
+
+def benchmark_summary_of_findings_extraction(page_cache, n=100):
+    # Compare fast and full-parse extraction on (up to n) pages from the page cache, check that both give identical output
+    contents = [page_cache.get(url)[0] for url, in page_cache.db.execute("SELECT url FROM pages LIMIT ?", (n,)).fetchall()]
+    timings = {}
+    results = {}
+    for extract in [extract_summary_of_findings_table_full_parse, extract_summary_of_findings_table]:
+        start = time.perf_counter()
+        results[extract.__name__] = [extract(i, content) for i, content in enumerate(contents)]
+        timings[extract.__name__] = time.perf_counter() - start
+    assert results["extract_summary_of_findings_table_full_parse"] == results["extract_summary_of_findings_table"]
+    print(f"{len(contents)} pages: full parse {timings['extract_summary_of_findings_table_full_parse']:.2f}s, fast extraction {timings['extract_summary_of_findings_table']:.2f}s ({timings['extract_summary_of_findings_table_full_parse'] / timings['extract_summary_of_findings_table']:.1f}x)")
+    return timings
+
+def check_summary_of_findings_extraction_parity(page_cache):
+    # Parity check of extract_summary_of_findings_table against the full parse over all pages in the page cache
+    # Returns the urls where the extracted SoF tables differ (should be an empty list)
+    mismatches = []
+    urls = [url for url, in page_cache.db.execute("SELECT url FROM pages").fetchall()]
+    for url in tqdm(urls):
+        content = page_cache.get(url)[0]
+        if extract_summary_of_findings_table(url, content) != extract_summary_of_findings_table_full_parse(url, content):
+            mismatches.append(url)
+    return mismatches
+
+class PageCache:
+    # Raw review pages on disk, content-addressed by sha256 (gzipped in objects/), plus an sqlite index url -> sha256, ETag, Last-Modified
+    # so unchanged pages can be revalidated with a conditional request (304) and parsing can be replayed offline
+    # get / put are called from worker threads (asyncio.to_thread) during the crawl, the lock serializes them
+    def __init__(self, cache_dir="data/page-cache", max_bytes=20 * 1024**3):
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, sha256 TEXT, etag TEXT, last_modified TEXT, size INTEGER, last_used REAL)")
+        self.db.commit()
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM pages)").fetchone()[0]
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256 + ".html.gz")
+
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT sha256, etag, last_modified FROM pages WHERE url = ?", (url,)).fetchone()
+            if not row:
+                return None
+            sha256, etag, last_modified = row
+            try:
+                with gzip.open(self.object_path(sha256), "rb") as file:
+                    content = file.read()
+            except FileNotFoundError:
+                # Blob was removed by hand, forget the entry
+                self.db.execute("DELETE FROM pages WHERE url = ?", (url,))
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE pages SET last_used = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+            return content, etag, last_modified
+
+    def conditional_headers(self, cached):
+        # Validators of a cached page for the next request (If-None-Match preferred by servers over If-Modified-Since)
+        if not cached:
+            return {}
+        _, etag, last_modified = cached
+        conditional_headers = {}
+        if etag:
+            conditional_headers["If-None-Match"] = etag
+        if last_modified:
+            conditional_headers["If-Modified-Since"] = last_modified
+        return conditional_headers
+
+    def put(self, url, content, etag=None, last_modified=None):
+        with self.lock:
+            sha256 = hashlib.sha256(content).hexdigest()
+            path = self.object_path(sha256)
+            is_new_object = not os.path.exists(path)
+            if is_new_object:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write to temporary file first, so a crash never leaves a truncated blob behind
+                with gzip.open(path + ".tmp", "wb") as file:
+                    file.write(content)
+                os.replace(path + ".tmp", path)
+            size = os.path.getsize(path)
+            previous = self.db.execute("SELECT sha256 FROM pages WHERE url = ?", (url,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)", (url, sha256, etag, last_modified, size, time.time()))
+            self.db.commit()
+            if is_new_object:
+                self.total_bytes += size
+            if previous and previous[0] != sha256:
+                self.remove_unreferenced_object(previous[0])
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def remove_unreferenced_object(self, sha256):
+        if self.db.execute("SELECT 1 FROM pages WHERE sha256 = ?", (sha256,)).fetchone():
+            return
+        path = self.object_path(sha256)
+        if os.path.exists(path):
+            self.total_bytes -= os.path.getsize(path)
+            os.remove(path)
+
+    def evict(self):
+        # Remove least recently used pages until the cache is below 90% of max_bytes
+        for url, sha256 in self.db.execute("SELECT url, sha256 FROM pages ORDER BY last_used").fetchall():
+            if self.total_bytes <= 0.9 * self.max_bytes:
+                break
+            self.db.execute("DELETE FROM pages WHERE url = ?", (url,))
+            self.remove_unreferenced_object(sha256)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+class SofTableStore:
+    # Checkpoint store id_version -> SoF html (None if no SoF table / failed), committed per result so a crash or Ctrl-C loses at most one review
+    # Behaves like the sof_tables dict (keys, in, [], []=) without holding all pages in memory
+    # status is "ok", "no-sof", the HTTP status code of a failed request or "error"; fetched_at is used to expire negative results
+    # record is called from a worker thread (asyncio.to_thread) during the crawl, the lock serializes the writes
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # WAL: each commit is a cheap append, readers (e.g. to_csv) don't block writers
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sof_tables (id_version TEXT PRIMARY KEY, sof TEXT, status TEXT, fetched_at REAL)")
+        self.db.commit()
+
+    def __setitem__(self, id_version, sof):
+        self.record(id_version, sof, "ok" if sof else "no-sof")
+
+    def record(self, id_version, sof, status):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO sof_tables VALUES (?, ?, ?, ?)", (id_version, sof, status, time.time()))
+            self.db.commit()
+
+    def __getitem__(self, id_version):
+        row = self.db.execute("SELECT sof FROM sof_tables WHERE id_version = ?", (id_version,)).fetchone()
+        if not row:
+            raise KeyError(id_version)
+        return row[0]
+
+    def __contains__(self, id_version):
+        return self.db.execute("SELECT 1 FROM sof_tables WHERE id_version = ?", (id_version,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM sof_tables").fetchone()[0]
+
+    def keys(self):
+        return [row[0] for row in self.db.execute("SELECT id_version FROM sof_tables")]
+
+    def items(self):
+        # (id_version, sof) of all reviews with a SoF table, sorted by id_version
+        return self.db.execute("SELECT id_version, sof FROM sof_tables WHERE sof IS NOT NULL ORDER BY id_version")
+
+    def update(self, sof_tables):
+        fetched_at = time.time()
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO sof_tables VALUES (?, ?, ?, ?)", ((id_version, sof, "ok" if sof else "no-sof", fetched_at) for id_version, sof in sof_tables.items()))
+            self.db.commit()
+
+    def is_fresh(self, id_version, negative_cache_ttl):
+        # SoF tables are kept for good, 404 / no SoF table only for negative_cache_ttl seconds, other failures (5xx, timeouts, ...) are always retried
+        row = self.db.execute("SELECT status, fetched_at FROM sof_tables WHERE id_version = ?", (id_version,)).fetchone()
+        if not row:
+            return False
+        status, fetched_at = row
+        if status == "ok":
+            return True
+        if status in ("no-sof", "404"):
+            return fetched_at > time.time() - negative_cache_ttl
+        return False
+
+    def import_pickle(self, path):
+        # One-off import of a sof_tables dict pickled by an earlier crawl
+        import pickle
+        with open(path, "rb") as file:
+            self.update(pickle.load(file))
+
+    def to_csv(self, path, chunksize=500):
+        # Same format as pd.DataFrame.from_dict(sof_tables, orient='index', columns=['sof']).sort_index().to_csv(path), written in chunks
+        chunks = pd.read_sql_query("SELECT id_version, sof FROM sof_tables ORDER BY id_version", self.db, index_col="id_version", chunksize=chunksize)
+        for i, chunk in enumerate(chunks):
+            chunk.index.name = None
+            chunk.to_csv(path, index=True, mode="w" if i == 0 else "a", header=i == 0)
+
+    def to_parquet(self, path, chunksize=500):
+        # Columns id_version, sof (sorted by id_version) as Parquet, written in chunks as row groups (needs pyarrow)
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([("id_version", pa.string()), ("sof", pa.string())])
+        with pq.ParquetWriter(path, schema) as writer:
+            for chunk in pd.read_sql_query("SELECT id_version, sof FROM sof_tables ORDER BY id_version", self.db, chunksize=chunksize):
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+    def close(self):
+        self.db.close()
+
+def split_id_version(id_version):
+    # "CD001234.PUB3" -> ("CD001234", 3), "CD001234" -> ("CD001234", 1)
+    id, _, pub = id_version.partition(".PUB")
+    return id, int(pub) if pub else 1
+
+def resolve_id_versions(id_version_list, sof_tables, fetch_older_versions_of=(), negative_cache_ttl=90 * 24 * 3600):
+    # (id_version, print_version_warning) still to fetch: the current version of each review (as in the citation export),
+    # older versions PUB{n-1} ... 1 only for ids in fetch_older_versions_of (downstream only the current version is used)
+    # Versions already in sof_tables are skipped, unless they are an expired negative result (404 / no SoF table) or a failed request
+    id_versions = {}
+    for id_version in id_version_list:
+        id, last_version = split_id_version(id_version)
+        versions = range(last_version, 0, -1) if id in fetch_older_versions_of else [last_version]
+        for version in versions:
+            id_version = id
+            if version > 1:
+                id_version += f".PUB{version}"
+            if id_version in id_versions:
+                continue
+            if isinstance(sof_tables, SofTableStore):
+                if sof_tables.is_fresh(id_version, negative_cache_ttl):
+                    continue
+            elif id_version in sof_tables:
+                continue
+            id_versions[id_version] = version==last_version
+    return list(id_versions.items())
+
+class HostRateLimiter:
+    # Spaces out request starts per host to at most requests_per_second (shared by all concurrent tasks)
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.next_slot = {}
+        self.lock = asyncio.Lock()
+
+    async def wait(self, url):
+        if not self.interval:
+            return
+        host = urlsplit(url).netloc
+        async with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+async def extract_with_status(id, page_content, print_version_warning):
+    # Parsing is CPU-bound, run it in a thread so the event loop can keep the other connections busy
+    # A page that can't be parsed is recorded as "error" (retried next run) instead of aborting the crawl
+    try:
+        sof_table = await asyncio.to_thread(extract_summary_of_findings_table, id, page_content, print_version_warning)
+    except Exception as e:
+        print(f"Failed to extract the SoF tables. ID: {id}. Error: {e!r}")
+        return None, "error"
+    return sof_table, "ok" if sof_table else "no-sof"
+
+# Statuses worth retrying: rate limiting and server errors (404 etc. are definitive)
+retry_statuses = {408, 429, 500, 502, 503, 504}
+
+def retry_after_seconds(retry_after):
+    # Retry-After is either delay-seconds or an HTTP date
+    if not retry_after:
+        return None
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        try:
+            return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def backoff_seconds(attempt, backoff_base=1, backoff_max=60, retry_after=None):
+    # Exponential backoff with full jitter, at least as long as the server asked for
+    delay = random.uniform(0, min(backoff_max, backoff_base * 2**attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+class CircuitBreaker:
+    # Pauses the whole crawl for cooldown seconds when more than error_rate of the last window requests failed (retryable status or connection error)
+    def __init__(self, window=50, error_rate=0.5, cooldown=120):
+        self.window = window
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.open_until = 0
+        self.times_opened = 0
+
+    async def wait(self):
+        while (remaining := self.open_until - time.monotonic()) > 0:
+            await asyncio.sleep(remaining)
+
+    def record(self, success):
+        self.outcomes.append(success)
+        if len(self.outcomes) == self.window and self.outcomes.count(False) > self.error_rate * self.window:
+            print(f"Circuit breaker open: {self.outcomes.count(False)} of the last {self.window} requests failed, pausing for {self.cooldown}s")
+            self.open_until = time.monotonic() + self.cooldown
+            self.times_opened += 1
+            # Start counting afresh after the pause
+            self.outcomes.clear()
+
+class FetchTelemetry:
+    # Per-run statistics of the fetcher: latencies, bytes transferred, status counts, retried ids
+    latency_bins = [0, 0.25, 0.5, 1, 2, 5, 10, 30, float("inf")]
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.latencies = []
+        self.bytes_transferred = 0
+        self.status_counts = Counter()
+        self.retried_ids = Counter()
+
+    def record(self, status, latency=None, nr_bytes=0):
+        self.status_counts[status] += 1
+        if latency is not None:
+            self.latencies.append(latency)
+        self.bytes_transferred += nr_bytes
+
+    def record_retry(self, id):
+        self.retried_ids[id] += 1
+
+    def latency_histogram(self):
+        return pd.cut(pd.Series(self.latencies, dtype=float), self.latency_bins, right=False).value_counts(sort=False)
+
+    def report(self):
+        duration = time.monotonic() - self.started_at
+        latencies = pd.Series(self.latencies, dtype=float)
+        lines = [
+            f"Fetch report: {sum(self.status_counts.values())} requests in {duration:.0f}s, {self.bytes_transferred / 1024**2:.1f} MB transferred",
+            "Status counts: " + ", ".join(f"{status}: {count}" for status, count in self.status_counts.most_common()),
+        ]
+        if len(latencies):
+            lines.append(f"Latency (s): median {latencies.median():.2f}, P90 {latencies.quantile(0.9):.2f}, max {latencies.max():.2f}")
+            lines += [f"  {str(interval):>14}: {count}" for interval, count in self.latency_histogram().items()]
+        lines.append(f"Retried ids ({len(self.retried_ids)}): " + ", ".join(f"{id} ({count}x)" for id, count in sorted(self.retried_ids.items())))
+        return "\n".join(lines)
+
+async def fetch_summary_of_findings_table(session, semaphore, rate_limiter, id, print_version_warning=False, base_url=cochrane_base_url, cache=None, offline=False, circuit_breaker=None, telemetry=None, max_retries=5):
+    url = review_url(id, base_url)
+    # Page cache and store I/O (sqlite, gzip) runs in threads, so it doesn't stall the other requests on the event loop
+    cached = await asyncio.to_thread(cache.get, url) if cache else None
+
+    # Offline: replay from cache only
+    if offline:
+        if not cached:
+            print(f"Not in page cache. ID: {id}")
+            return id, None, "error"
+        return (id, *await extract_with_status(id, cached[0], print_version_warning))
+
+    for attempt in range(max_retries + 1):
+        if circuit_breaker:
+            await circuit_breaker.wait()
+        retry_after = None
+        async with semaphore:
+            await rate_limiter.wait(url)
+            request_start = time.monotonic()
+            try:
+                async with session.get(url, headers=cache.conditional_headers(cached) if cache else None) as response:
+                    status = response.status
+                    # Check if the request was successful
+                    if status == 200:
+                        page_content = await response.read()
+                        if cache:
+                            await asyncio.to_thread(cache.put, url, page_content, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+                    elif status == 304 and cached:
+                        # Not modified since the cached version
+                        page_content = cached[0]
+                    else:
+                        retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+                    nr_bytes = response.content.total_bytes
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, error, nr_bytes = "error", e, 0
+            if telemetry:
+                telemetry.record(str(status), time.monotonic() - request_start, nr_bytes)
+
+        retryable = status == "error" or status in retry_statuses
+        if circuit_breaker:
+            circuit_breaker.record(not retryable)
+        if status == 200 or (status == 304 and cached):
+            return (id, *await extract_with_status(id, page_content, print_version_warning))
+        if not retryable or attempt == max_retries:
+            break
+        if telemetry:
+            telemetry.record_retry(id)
+        # Sleep outside the semaphore, so the other requests can use the connection
+        await asyncio.sleep(backoff_seconds(attempt, retry_after=retry_after))
+
+    if status == "error":
+        print(f"Failed to retrieve the page. ID: {id}. Error: {error!r}")
+    else:
+        print(f"Failed to retrieve the page. ID: {id}. Status code: {status}")
+    return id, None, str(status)
+
+async def fetch_summary_of_findings_tables(id_versions, max_concurrent=8, requests_per_second=4, base_url=cochrane_base_url, timeout=60, cache=None, offline=False, sof_tables=None, max_retries=5, circuit_breaker=None, telemetry=None):
+    # id_versions: list of (id_version, print_version_warning) tuples
+    # sof_tables: dict-like (e.g. SofTableStore) each result is written to as soon as it arrives, otherwise a new dict is returned
+    semaphore = asyncio.Semaphore(max_concurrent)
+    rate_limiter = HostRateLimiter(requests_per_second)
+    if circuit_breaker is None:
+        circuit_breaker = CircuitBreaker()
+    # One pooled keep-alive connector for the whole run (limit_per_host matches the semaphore)
+    connector = aiohttp.TCPConnector(limit=max_concurrent, limit_per_host=max_concurrent, keepalive_timeout=30)
+    return_dict = sof_tables is None
+    if return_dict:
+        sof_tables = {}
+    async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        tasks = [fetch_summary_of_findings_table(session, semaphore, rate_limiter, id, print_version_warning, base_url, cache, offline, circuit_breaker, telemetry, max_retries) for id, print_version_warning in id_versions]
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            id, sof_table, status = await task
+            if isinstance(sof_tables, SofTableStore):
+                await asyncio.to_thread(sof_tables.record, id, sof_table, status)
+            else:
+                sof_tables[id] = sof_table
+    if return_dict:
+        # Keep input order (as_completed yields in completion order)
+        return {id: sof_tables[id] for id, _ in id_versions}
+    return sof_tables
+
+def retrieve_summary_of_findings_tables(id_versions, max_concurrent=8, requests_per_second=4, base_url=cochrane_base_url, cache=None, offline=False, sof_tables=None, max_retries=5, circuit_breaker=None, telemetry=None):
+    return asyncio.run(fetch_summary_of_findings_tables(id_versions, max_concurrent, requests_per_second, base_url, cache=cache, offline=offline, sof_tables=sof_tables, max_retries=max_retries, circuit_breaker=circuit_breaker, telemetry=telemetry))
+
+def retrieve_summary_of_findings_table(id, print_version_warning=False, base_url=cochrane_base_url, cache=None, offline=False):
+    return retrieve_summary_of_findings_tables([(id, print_version_warning)], max_concurrent=1, base_url=base_url, cache=cache, offline=offline)[id]
@@ -1,8 +1,21 @@
 #%%
+import os
 import re
+import copy
+import zlib
+import time
+import pickle
+import signal
+import functools
+import threading
+import sqlite3
+import hashlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
-from io import StringIO
+from io import StringIO, BytesIO
+from pandas.io.parsers import TextParser
 import matplotlib.pyplot as plt
 
 flags = re.IGNORECASE | re.MULTILINE
@@ -11,8 +24,105 @@ number = r"(?:(?:no.?|number|№) *(?:of)? *)"
 participants = r"(?:(?:participants|patients|persons|people|women|men|children|infants|babies|neonates|births|eyes|couples|limbs|teeth|procedures|episodes|intubations|paa|restorations|ulcers|lps):?\s*)"
 studies = r"(?:(?:randomised|randomized|observational|cross-over|cross‐over|quasi|cohort|case-control|case‐control|cluster|its)?(?:-|‐|\s*)?(?:study|studie|trial|rct)s?:?\s*)"
 
-def table_merged_df(table):
-    full_table_df = pd.read_html(StringIO(str(table)))[0].fillna('')
+def is_plain_table(table):
+    # Structures where the table_grid of the bs4 rows is guaranteed to match pd.read_html (lxml) of the serialized table:
+    # no nested tables, <th>, <thead>/<tfoot> or hidden/script content, every <tr> directly in <table>/<tbody> and every cell directly in a <tr>
+    for element in table.find_all(True):
+        if element.name in ('table', 'th', 'thead', 'tfoot', 'style', 'script', 'template'):
+            return False
+        if element.name == 'tr' and element.parent.name not in ('table', 'tbody'):
+            return False
+        if element.name == 'td' and element.parent.name != 'tr':
+            return False
+        if 'display:none' in str(element.get('style', '')).replace(' ', ''):
+            return False
+    return True
+
+def cell_text(td):
+    # Text as pd.read_html sees it: lxml's text_content() with a line break added for every <br>, whitespace collapsed as in
+    # pandas' _remove_whitespace (only line breaks and runs of 2+ whitespace, a single tab / thin space / no-break space stays)
+    from bs4 import NavigableString
+    texts = []
+    for element in td.descendants:
+        if type(element) is NavigableString:
+            texts.append(element)
+        elif element.name == 'br':
+            texts.append('\n')
+    return re.sub(r'[\r\n]+|\s{2,}', ' ', ''.join(texts).strip())
+
+def table_grid(rows):
+    # Cell texts of the <tr> elements with rowspan/colspan expanded into copies, same algorithm as pd.read_html
+    # (incl. extra rows at the bottom that only exist because of a rowspan)
+    grid = []
+    remainder = [] # (column index, text, remaining rowspan) of cells reaching into the next row
+    for tr in rows:
+        texts = []
+        next_remainder = []
+        index = 0
+        for td in tr.find_all('td', recursive=False):
+            # Cells from previous rows with rowspan > 1 that come before this td
+            while remainder and remainder[0][0] <= index:
+                prev_index, prev_text, prev_rowspan = remainder.pop(0)
+                texts.append(prev_text)
+                if prev_rowspan > 1:
+                    next_remainder.append((prev_index, prev_text, prev_rowspan - 1))
+                index += 1
+            text = cell_text(td)
+            rowspan = int(td.get('rowspan') or 1)
+            colspan = int(td.get('colspan') or 1)
+            for _ in range(colspan):
+                texts.append(text)
+                if rowspan > 1:
+                    next_remainder.append((index, text, rowspan - 1))
+                index += 1
+        # Cells from previous rows after the last td
+        for prev_index, prev_text, prev_rowspan in remainder:
+            texts.append(prev_text)
+            if prev_rowspan > 1:
+                next_remainder.append((prev_index, prev_text, prev_rowspan - 1))
+        grid.append(texts)
+        remainder = next_remainder
+    while remainder:
+        grid.append([prev_text for _, prev_text, _ in remainder])
+        remainder = [(prev_index, prev_text, prev_rowspan - 1) for prev_index, prev_text, prev_rowspan in remainder if prev_rowspan > 1]
+    return grid
+
+def grid_df(grid):
+    # Pad ragged rows with '' and infer dtypes exactly like pd.read_html does (TextParser, thousands separator ',')
+    max_len = max(len(row) for row in grid)
+    grid = [row + [''] * (max_len - len(row)) for row in grid]
+    with TextParser(grid, header=None, thousands=',') as parser:
+        return parser.read()
+
+def read_table_rows(table, rows=None, use_read_html=False):
+    # Same as pd.read_html(StringIO(str(table)))[0] (or of f'<table>{rows}</table>' if rows are given), but built directly from the bs4 elements
+    # instead of serializing and re-parsing them with lxml. Falls back to pd.read_html for unusual structures (see is_plain_table)
+    if rows is None:
+        rows = table.find_all('tr')
+        rows = [row for row in rows if row.parent.name == 'tbody'] + [row for row in rows if row.parent.name == 'table']
+        html = str(table)
+    else:
+        html = f'<table>{rows}</table>'
+    if not use_read_html and is_plain_table(table):
+        grid = table_grid(rows)
+        # pd.read_html raises if there is no text at all, keep that behaviour
+        if any(text for row in grid for text in row):
+            return grid_df(grid)
+    return pd.read_html(StringIO(html))[0]
+
+def row_values(row):
+    # Values of pd.Series(row).to_list(): rows with a string stay as they are, others get the Series dtype (e.g. ints and floats become floats)
+    return row if any(isinstance(x, str) for x in row) else pd.Series(row).to_list()
+
+def merge_first_columns(table_df):
+    # Merge 1st and 2nd column with \n where they differ and remove the 2nd column
+    first, second = table_df.loc[:,0].to_list(), table_df.loc[:,1].to_list()
+    table_df = table_df.drop(table_df.columns[1], axis=1)
+    table_df[0] = [a + '\n' + b if a != b else a for a, b in zip(first, second)]
+    return table_df
+
+def table_merged_df(table, use_read_html=False):
+    full_table_df = read_table_rows(table, use_read_html=use_read_html).fillna('')
     full_table_df = full_table_df.loc[:, ~(full_table_df == '').all()]
     max_columns = full_table_df.shape[1]
     # Old approach: First cell often indicates table width through its colspan attribute (but not always, compare e.g. CD008624.PUB2)
@@ -47,7 +157,7 @@ def table_merged_df(table):
     if not len(main_rows):
         return False
     
-    table_df = pd.read_html(StringIO(f'<table>{main_rows}</table>'))[0].fillna('')
+    table_df = read_table_rows(table, main_rows, use_read_html=use_read_html).fillna('')
 
     # Remove completely empty columns (incl. empty column name, e.g. CD006208.PUB3)
     table_df = table_df.loc[:, ~(table_df == '').all()]
@@ -57,16 +167,10 @@ def table_merged_df(table):
     # If 1st column is "Outcomes" and 2nd column is "Comparison": merge them with \n (e.g. CD000528.PUB2)
     if  (str(table_df.loc[0,0]).startswith('Outcome') and str(table_df.loc[0,1]).startswith('Outcome')): #or\
         #((table_df.loc[0,0].startswith('Outcome')) and (('Comparison' in table_df.loc[0,1]) or 'comparison' in table_df.loc[0,1])):
-        rows_diff = table_df.loc[:,0] != table_df.loc[:,1]
-        table_df.loc[rows_diff, 0] = table_df.loc[rows_diff, 0] + '\n' + table_df.loc[rows_diff, 1]
-        # Remove second outcome column
-        table_df = table_df.drop(table_df.columns[1], axis=1)
+        table_df = merge_first_columns(table_df)
     
     if  (re.search(r'^Outcome|Intervention|Treatment', str(table_df.iloc[0,0]), re.IGNORECASE) and re.search(r"Comparison|Primary outcome measure", str(table_df.iloc[0,1]), re.IGNORECASE)):
-        rows_diff = table_df.loc[:,0] != table_df.loc[:,1]
-        table_df.loc[rows_diff, 0] = table_df.loc[rows_diff, 0] + '\n' + table_df.loc[rows_diff, 1]
-        # Remove second outcome column
-        table_df = table_df.drop(table_df.columns[1], axis=1)
+        table_df = merge_first_columns(table_df)
         # IDs with "Comparison" / "comparison" in 2nd column: ['CD000425.PUB4' 'CD000528.PUB2' 'CD001168.PUB3' 'CD004063.PUB4', 'CD005468.PUB2' 'CD006208.PUB3' 'CD006745.PUB3' 'CD007039.PUB3', 'CD007825.PUB6' 'CD008117.PUB2' 'CD008326.PUB2' 'CD008797.PUB2', 'CD010036.PUB2' 'CD010293.PUB2' 'CD010393.PUB2' 'CD011034.PUB2', 'CD011376.PUB3' 'CD012421']
         # print(f"Merged 1st and 2nd columns: {id}")
 
@@ -75,13 +179,11 @@ def table_merged_df(table):
     new_rows = [rows[0]]
     upper_left_cell = new_rows[0][0]
     for i in range(1, len(rows)):
-        current_row = pd.Series(rows[i])
-        prev_row = pd.Series(new_rows[-1])
-        cols_diff = current_row != prev_row
-        #if current_row[0] == '' or not cols_diff[0]:
+        current_row = row_values(rows[i])
+        prev_row = row_values(new_rows[-1])
+        #if current_row[0] == '' or current_row[0] == prev_row[0]:
         if current_row[0] == '' or current_row[0] == upper_left_cell or prev_row[0] == '':
-            prev_row[cols_diff] = prev_row[cols_diff].astype(str) + '\n' + current_row[cols_diff].astype(str)
-            new_rows[-1] = prev_row.to_list()
+            new_rows[-1] = [str(prev) + '\n' + str(current) if prev != current else prev for prev, current in zip(prev_row, current_row)]
         else:
             new_rows += rows[i:]
             break
@@ -104,223 +206,1116 @@ def table_merged_df(table):
 
     return (table_title, header_rows, footer_rows, table_df, merged_df)
 
-def get_columns(merged_df):
-    columns = merged_df.columns
-    get_column = lambda contains, flags=flags: columns[columns.astype(str).str.contains(contains, flags=flags)][0] if columns.astype(str).str.contains(contains, flags=flags).any() else 'NA'
+class LRUMemo:
+    # Bounded memo table that keeps the most recently used results
+    def __init__(self, maxsize=100_000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+        return None
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.data)}
+
+def get_column_positions(columns):
+    # Header-only part of get_columns on the str column labels: positions of relative_effects_col, nr_participants_studies_col, certainty_col (None if not found)
+    def get_column(contains, flags=flags):
+        matches = columns.str.contains(contains, flags=flags)
+        return int(matches.argmax()) if matches.any() else None
 
-    rownames_col = columns[0]
     relative_effects_col = get_column(r'^Relative +|^Risk +ratio|^Odds +ratio|^Hazard +ratio|^RR +\(95%|^OR +\(95%| RR +\(95%| OR +\(95%')
-    if relative_effects_col == 'NA':
+    if relative_effects_col is None:
         relative_effects_col = get_column(r'^RR\b.*\(95%|^OR\b.*\(95%', re.MULTILINE)
     
     #nr_participants_studies_col = get_column('No.? +of +participants|Number +of +participants|№ +of +participants|No.? +of +patients|Number +of +patients|№ +of +patients|Participants.*\s*stud')
-    nr_participants_studies_col_str = rf'{number}{participants}'
-    nr_participants_studies_col = get_column(nr_participants_studies_col_str)
-    if nr_participants_studies_col == 'NA':
-        nr_participants_studies_col_str += rf'|{participants}.*\s*{studies}|{number}{studies}'
-        nr_participants_studies_col = get_column(nr_participants_studies_col_str)
-    # In >40 reviews (e.g. CD003376.PUB4), "No of participants (studies)" is in Outcomes column without the header acknowledging it (less often it's acknowledged: ['CD009596.PUB4', 'CD011991.PUB2', 'CD011992.PUB2', 'CD011993.PUB2','CD011994.PUB2', 'CD011995.PUB2', 'CD011996.PUB2', 'CD012023.PUB2','CD013307.PUB3', 'CD013799.PUB2', 'CD015087.PUB2'])
-    if nr_participants_studies_col == 'NA':
-        nr_participants_studies_col_str += rf"|\d+ +{participants}"
-        if merged_df[rownames_col].astype(str).str.contains(nr_participants_studies_col_str, flags=flags).any():
-            nr_participants_studies_col = rownames_col
+    nr_participants_studies_col = get_column(rf'{number}{participants}')
+    if nr_participants_studies_col is None:
+        nr_participants_studies_col = get_column(rf'{number}{participants}|{participants}.*\s*{studies}|{number}{studies}')
     
     certainty_col = get_column(r'^Certainty.*\s*GRADE|^Quality.*\s*GRADE') # Should contain both "Certainty|Quality" AND "GRADE", otherwise less specific (compare e.g. CD009273.PUB2)
-    if certainty_col == 'NA':
+    if certainty_col is None:
         certainty_col = get_column(r'^Certainty|^Quality|^Overall certainty|^Overall quality|GRADE')
     
+    return relative_effects_col, nr_participants_studies_col, certainty_col
+
+# Header signature (tuple of str column labels) -> get_column_positions, since the standard GRADEpro templates produce the same headers across reviews
+# Only unseen layouts are matched against the regexes, get_columns_memo.stats() shows the template coverage
+get_columns_memo = LRUMemo()
+rownames_nr_participants_studies_re = re.compile(rf'{number}{participants}|{participants}.*\s*{studies}|{number}{studies}|\d+ +{participants}', flags)
+
+def get_columns(merged_df):
+    columns = merged_df.columns
+    signature = tuple(columns.astype(str))
+    positions = get_columns_memo.get(signature)
+    if positions is None:
+        positions = get_column_positions(pd.Index(signature, dtype=object))
+        get_columns_memo[signature] = positions
+
+    rownames_col = columns[0]
+    relative_effects_col, nr_participants_studies_col, certainty_col = [columns[position] if position is not None else 'NA' for position in positions]
+    # In >40 reviews (e.g. CD003376.PUB4), "No of participants (studies)" is in Outcomes column without the header acknowledging it (less often it's acknowledged: ['CD009596.PUB4', 'CD011991.PUB2', 'CD011992.PUB2', 'CD011993.PUB2','CD011994.PUB2', 'CD011995.PUB2', 'CD011996.PUB2', 'CD012023.PUB2','CD013307.PUB3', 'CD013799.PUB2', 'CD015087.PUB2'])
+    # (depends on the cells, so it is not part of the header signature)
+    if nr_participants_studies_col == 'NA':
+        if merged_df[rownames_col].astype(str).str.contains(rownames_nr_participants_studies_re).any():
+            nr_participants_studies_col = rownames_col
+    
     return rownames_col, relative_effects_col, nr_participants_studies_col, certainty_col
 
-def extract_relative_effects_numbers_quality(combined_sof_df):
-    # Extract certainty_cleaned
-    grade = ["verylw", "low", "moderate", "high"]
-    def match_grade(x):
-        x= str(x).lower()
-        x= x.replace("high risk", "") # CD003010.PUB5
-        x= x.replace("high cardiovascular risk", "")
-        x= x.replace("verylow", "very low") # CD008649.PUB4
-        x= x.replace("m oderate", "moderate") # CD007880.PUB3
-        x= x.replace("l ow", "low") # CD004711.PUB3
-        x= x.replace("very low", "verylw") # to differentiate very low and low
-        #matches = [g for g in grade if g in x]
-        matches = [g for g in grade if re.search(rf"\b{g}", x)] # leading \b is important (e.g. "follow"), but following \b is not suitable because of superscript letters immediately afterwards ("e.g. lowa,b,c")
-        if len(matches) >= 1:
-            if matches[0] == "verylw":
-                matches[0] = "very low"
-            return ",".join(matches)
+def check_table_merged_df_parity(sof_tables):
+    # Parity check of the table grid builder against pd.read_html over a corpus (Series cochrane_id -> SoF html)
+    # Returns (cochrane_id, table_nr) of tables where table_df or merged_df differ (values, column names or dtypes)
+    from tqdm import tqdm
+    mismatches = []
+    for id, html_content in tqdm(sof_tables.items(), total=len(sof_tables)):
+        for table_nr, table in enumerate(sof_soup(html_content).find_all('table', class_='summary-of-findings')):
+            try:
+                result_read_html = table_merged_df(table, use_read_html=True)
+            except Exception as e:
+                result_read_html = repr(e)
+            try:
+                result_grid = table_merged_df(table)
+            except Exception as e:
+                result_grid = repr(e)
+            if isinstance(result_read_html, tuple) and isinstance(result_grid, tuple):
+                equal = all(a.equals(b) and a.columns.equals(b.columns) and (a.dtypes == b.dtypes).all() for a, b in zip(result_read_html[3:], result_grid[3:]))
+            else:
+                equal = result_read_html == result_grid
+            if not equal:
+                mismatches.append((id, table_nr + 1))
+    return mismatches
+
+combined_sof_df_columns = ['cochrane_id', 'table_nr', 'table_title', 'rownames_col', 'relative_effects_col', 'nr_participants_studies_col', 'certainty_col', 'row_nr', 'rowname', 'relative_effects', 'nr_participants_studies', 'certainty']
+# Columns with one value per SoF table (cochrane_id, table_nr), kept once per table in the compact model, and the columns of its outcomes
+sof_table_columns = ['cochrane_id', 'table_nr', 'table_title', 'rownames_col', 'relative_effects_col', 'nr_participants_studies_col', 'certainty_col']
+sof_outcome_columns = ['cochrane_id', 'table_nr', 'row_nr', 'rowname', 'relative_effects', 'nr_participants_studies', 'certainty']
+
+def categorize_sof_tables(sof_tables_df, outcomes_df):
+    # The join keys cochrane_id and table_nr as categoricals with the same categories in both frames of the compact model
+    for column in ["cochrane_id", "table_nr"]:
+        values = sof_tables_df[column].dropna().unique()
+        dtype = pd.CategoricalDtype(sorted(values) if column == "table_nr" else values)
+        sof_tables_df[column] = sof_tables_df[column].astype(dtype)
+        outcomes_df[column] = outcomes_df[column].astype(dtype)
+    return sof_tables_df, outcomes_df
+
+def split_sof_tables(combined_sof_df):
+    # Compact model of a combined_sof_df / parsed_sof_df read from disk: (sof_tables_df, outcomes_df), the table level columns once per
+    # table in sof_tables_df and the outcomes with only (cochrane_id, table_nr) of their table (parse_sof_tables(compact=True) builds it directly)
+    table_columns = [column for column in sof_table_columns if column in combined_sof_df.columns]
+    sof_tables_df = combined_sof_df[table_columns].drop_duplicates(["cochrane_id", "table_nr"]).reset_index(drop=True)
+    outcomes_df = combined_sof_df.drop(columns=table_columns[2:]).reset_index(drop=True)
+    return categorize_sof_tables(sof_tables_df, outcomes_df)
+
+def join_sof_tables(sof_tables_df, outcomes_df, columns=None):
+    # combined_sof_df / parsed_sof_df (in outcomes_df order, columns in the order of combined_sof_df_columns or the given columns) from the compact model
+    df = outcomes_df.merge(sof_tables_df, on=["cochrane_id", "table_nr"], how="left", sort=False)
+    if columns is None:
+        columns = [column for column in combined_sof_df_columns if column in df.columns] + [column for column in outcomes_df.columns if column not in combined_sof_df_columns]
+    return df[columns]
+
+# Dtypes of the pipeline tables, applied by write_table for the optional Parquet outputs (which store them, so nothing is re-inferred on load)
+# Estimates stay float64: float32 would move values like 0.2 off the 1/x effect size cutoffs used in the dashboard
+table_dtypes = {
+    "sof_tables": {
+        "id_version": object, "sof": object,
+    },
+    "combined_sof_df": {
+        "cochrane_id": "category", "table_nr": "Int32", "table_title": object, "rownames_col": object, "relative_effects_col": object, "nr_participants_studies_col": object, "certainty_col": object,
+        "row_nr": "Int32", "rowname": object, "relative_effects": object, "nr_participants_studies": object, "certainty": object,
+    },
+    "parsed_sof_df": {
+        "cochrane_id": "category", "table_nr": "Int32", "table_title": object, "row_nr": "Int32", "rowname": object,
+        "effect_type": "category", "point_estimate": "float64", "lower_ci": "float64", "upper_ci": "float64", "nr_participants_cleaned": "Int64", "nr_studies_cleaned": "Int32", "certainty_cleaned": "category",
+    },
+    "final_sof_df": {
+        "cochrane_id": "category", "table_nr": "Int32",
+        "effect_type": "category", "point_estimate": "float64", "lower_ci": "float64", "upper_ci": "float64", "nr_participants_cleaned": "Int64", "nr_studies_cleaned": "Int32", "certainty_cleaned": "category",
+        "primary_outcome": bool, "mortality_outcome": bool,
+    },
+    "final_cochrane_info": {
+        "Cochrane Review ID": object, "Title": object, "Year": "Int16", "Issue": "Int8", "Keywords": object, "Cochrane Review Group Code": object,
+    },
+}
+
+# Strings that pd.read_csv reads back as missing (its default na_values, e.g. "NA" of an ungraded certainty_cleaned) and empty fields
+csv_na_values = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+
+def csv_missing_values(df):
+    # Text columns with the csv_na_values replaced by NaN, so a typed (Parquet) table has the same missing values as after a CSV round trip
+    df = df.copy()
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].cat.remove_categories([value for value in df[column].cat.categories if value in csv_na_values])
+        elif df[column].dtype == object:
+            df[column] = df[column].mask(df[column].isin(csv_na_values))
+    return df
+
+def write_table(df, path, table, index=False):
+    # CSV, or for a .parquet path Parquet (needs pyarrow) with the dtypes of table_dtypes[table] and the missing values of the CSV
+    if path.endswith(".parquet"):
+        csv_missing_values(df).astype({column: dtype for column, dtype in table_dtypes[table].items() if column in df.columns}).to_parquet(path, index=index)
+    else:
+        df.to_csv(path, index=index)
+
+def read_table(path, columns=None, index_col=None):
+    # CSV or Parquet (by extension), only the given columns; index_col as in pd.read_csv (a position among the columns)
+    if path.endswith(".parquet"):
+        df = pd.read_parquet(path, columns=columns)
+        return df.set_index(df.columns[index_col]) if index_col is not None else df
+    return pd.read_csv(path, usecols=columns, index_col=index_col)
+
+def check_table_format_parity(df, table):
+    # Round trip of df through write_table / read_table as CSV and as Parquet (needs pyarrow)
+    # Returns the columns whose values differ (Parquet values compared in the dtypes read from the CSV), should be an empty list
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        write_table(df, os.path.join(directory, "table.csv"), table)
+        write_table(df, os.path.join(directory, "table.parquet"), table)
+        csv_df = read_table(os.path.join(directory, "table.csv"))
+        parquet_df = read_table(os.path.join(directory, "table.parquet"))
+    mismatches = []
+    for column in csv_df.columns:
+        parquet_values = parquet_df[column].astype(object).where(parquet_df[column].notna(), np.nan).astype(csv_df[column].dtype)
+        if not csv_df[column].equals(parquet_values):
+            mismatches.append(column)
+    return mismatches
+
+def compress_html(html_content, level=9):
+    # (codec, blob): zstd (zstandard is in requirements.txt); without zstandard installed the store falls back to zlib, the codec is stored per row so both read back
+    try:
+        import zstandard
+    except ImportError:
+        return "zlib", zlib.compress(html_content.encode(), level)
+    return "zstd", zstandard.ZstdCompressor(level=level).compress(html_content.encode())
+
+def decompress_html(codec, blob):
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(blob).decode()
+    return zlib.decompress(blob).decode()
+
+class SofHtmlStore:
+    # Raw SoF html per review as compressed blobs in sqlite: one review is read by its primary key (cochrane_id) without loading all others,
+    # items() streams the reviews in cochrane_id order (same order as the sorted CSV export). The codec is stored per row, and the
+    # ParseCache.html_hash of the html, so the parse cache can be checked without decompressing
+    def __init__(self, path):
+        # One connection is shared by the Streamlit sessions of the dashboard, the lock serializes its use
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS sof_html (cochrane_id TEXT PRIMARY KEY, codec TEXT, html BLOB, html_hash TEXT)")
+        # Stores written before html_hash was added: hashes are filled in by html_hashes()
+        if "html_hash" not in [row[1] for row in self.db.execute("PRAGMA table_info(sof_html)")]:
+            self.db.execute("ALTER TABLE sof_html ADD COLUMN html_hash TEXT")
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.ids = None
+
+    def subset(self, ids):
+        # View of the same store restricted to ids (e.g. the reviews in cochrane_info)
+        view = copy.copy(self)
+        view.ids = set(ids)
+        return view
+
+    def __getitem__(self, cochrane_id):
+        if self.ids is not None and cochrane_id not in self.ids:
+            raise KeyError(cochrane_id)
+        with self.lock:
+            row = self.db.execute("SELECT codec, html FROM sof_html WHERE cochrane_id = ?", (cochrane_id,)).fetchone()
+        if not row:
+            raise KeyError(cochrane_id)
+        return decompress_html(*row)
+
+    def __contains__(self, cochrane_id):
+        if self.ids is not None and cochrane_id not in self.ids:
+            return False
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM sof_html WHERE cochrane_id = ?", (cochrane_id,)).fetchone() is not None
+
+    def keys(self):
+        with self.lock:
+            keys = [row[0] for row in self.db.execute("SELECT cochrane_id FROM sof_html ORDER BY cochrane_id")]
+        return keys if self.ids is None else [id for id in keys if id in self.ids]
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self, chunksize=500):
+        # Generator of (cochrane_id, html), only chunksize compressed reviews are read at a time
+        keys = self.keys()
+        for i in range(0, len(keys), chunksize):
+            chunk = keys[i:i+chunksize]
+            with self.lock:
+                rows = {id: (codec, html) for id, codec, html in self.db.execute(f"SELECT cochrane_id, codec, html FROM sof_html WHERE cochrane_id IN ({','.join('?' * len(chunk))})", chunk)}
+            for id in chunk:
+                yield id, decompress_html(*rows[id])
+
+    def html_hashes(self):
+        # dict cochrane_id -> ParseCache.html_hash of the html (hashes missing in older stores are computed once and stored)
+        with self.lock:
+            hashes = dict(self.db.execute("SELECT cochrane_id, html_hash FROM sof_html"))
+            missing = [id for id, html_hash in hashes.items() if html_hash is None and (self.ids is None or id in self.ids)]
+            for id in missing:
+                hashes[id] = ParseCache.html_hash(decompress_html(*self.db.execute("SELECT codec, html FROM sof_html WHERE cochrane_id = ?", (id,)).fetchone()))
+            self.db.executemany("UPDATE sof_html SET html_hash = ? WHERE cochrane_id = ?", ((hashes[id], id) for id in missing))
+            self.db.commit()
+        return {id: hashes[id] for id in self.keys()}
+
+    def update(self, items):
+        # items: (cochrane_id, html) pairs, e.g. SofTableStore.items() or the items of a Series / dict; reviews without html are skipped
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO sof_html VALUES (?, ?, ?, ?)", ((id, *compress_html(html_content), ParseCache.html_hash(html_content)) for id, html_content in items if isinstance(html_content, str) and html_content))
+            self.db.commit()
+
+    def import_table(self, path):
+        # One-off import of a CSV / Parquet export of the SoF tables (index: cochrane_id, column sof)
+        self.update(read_table(path, index_col=0)["sof"].items())
+
+    def close(self):
+        self.db.close()
+
+manual_extraction_columns = {"cochrane_id": "TEXT", "table_nr": "INTEGER", "row_nr": "INTEGER", "rowname": "TEXT", "effect_type": "TEXT", "point_estimate": "REAL", "lower_ci": "REAL", "upper_ci": "REAL",
+                             "nr_participants_cleaned": "REAL", "nr_studies_cleaned": "REAL", "certainty_cleaned": "TEXT"}
+
+class ManualExtractionStore:
+    # Manually extracted outcomes of all reviewed reviews in one sqlite table (uniform schema manual_extraction_columns, indexed by cochrane_id),
+    # kept in sync with the per-review CSVs of the manual extraction folder: review_set "included" (the folder itself), "test" (test/)
+    # and "excluded" (excluded/, only the cochrane_id is recorded). Files are only read again if their mtime or size changed
+    # Only the manual_extraction_columns (the download format of the manual checks dashboard) are kept, other CSV columns are dropped with a warning
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS manual_files (review_set TEXT, cochrane_id TEXT, mtime REAL, size INTEGER, PRIMARY KEY (review_set, cochrane_id))")
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS manual_sof (review_set TEXT, {', '.join(f'{column} {type}' for column, type in manual_extraction_columns.items())})")
+        self.db.execute("CREATE INDEX IF NOT EXISTS manual_sof_cochrane_id ON manual_sof (cochrane_id, review_set)")
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    def upsert(self, review_set, cochrane_id, manual_sof_df=None, mtime=None, size=None):
+        # Replaces the outcomes of cochrane_id in review_set (manual_sof_df: as downloaded from the manual checks dashboard, None for excluded reviews)
+        if manual_sof_df is not None:
+            manual_sof_df = manual_sof_df.reset_index(drop=True)
+            manual_sof_df["cochrane_id"] = cochrane_id
+            # row_nr missing in older manual_extraction files (not in test files though)
+            if not "row_nr" in manual_sof_df.columns:
+                manual_sof_df["row_nr"] = manual_sof_df.groupby("table_nr").cumcount() + 1
+            dropped_columns = [column for column in manual_sof_df.columns if column not in manual_extraction_columns]
+            if dropped_columns:
+                print(f"Manual extraction: columns {dropped_columns} of {review_set}/{cochrane_id} are not stored")
+            manual_sof_df = manual_sof_df.reindex(columns=list(manual_extraction_columns))
+        with self.lock:
+            self.db.execute("DELETE FROM manual_sof WHERE review_set = ? AND cochrane_id = ?", (review_set, cochrane_id))
+            if manual_sof_df is not None:
+                rows = manual_sof_df.astype(object).where(manual_sof_df.notna(), None).itertuples(index=False)
+                self.db.executemany(f"INSERT INTO manual_sof VALUES (?, {', '.join('?' * len(manual_extraction_columns))})", ((review_set, *row) for row in rows))
+            self.db.execute("INSERT OR REPLACE INTO manual_files VALUES (?, ?, ?, ?)", (review_set, cochrane_id, mtime, size))
+            self.db.commit()
+
+    def remove(self, review_set, cochrane_id):
+        with self.lock:
+            self.db.execute("DELETE FROM manual_sof WHERE review_set = ? AND cochrane_id = ?", (review_set, cochrane_id))
+            self.db.execute("DELETE FROM manual_files WHERE review_set = ? AND cochrane_id = ?", (review_set, cochrane_id))
+            self.db.commit()
+
+    def import_csv(self, path, review_set):
+        cochrane_id = re.sub(r"\.csv.*", "", os.path.basename(path))
+        stat = os.stat(path)
+        self.upsert(review_set, cochrane_id, pd.read_csv(path) if review_set != "excluded" else None, stat.st_mtime, stat.st_size)
+
+    def sync(self, path):
+        # Imports new and changed files of the manual extraction folder path, removes reviews whose file was deleted. Returns the number of (imported, removed) files
+        files = {}
+        for review_set, folder in (("included", path), ("test", f"{path}test/"), ("excluded", f"{path}excluded/")):
+            for entry in os.scandir(folder):
+                if entry.is_file() and (review_set == "excluded" or entry.name.endswith(".csv")):
+                    files[(review_set, re.sub(r"\.csv.*", "", entry.name))] = entry
+        with self.lock:
+            known = {(review_set, cochrane_id): (mtime, size) for review_set, cochrane_id, mtime, size in self.db.execute("SELECT review_set, cochrane_id, mtime, size FROM manual_files")}
+        imported = 0
+        for (review_set, cochrane_id), entry in files.items():
+            stat = entry.stat()
+            if known.get((review_set, cochrane_id)) != (stat.st_mtime, stat.st_size):
+                self.import_csv(entry.path, review_set)
+                imported += 1
+        removed = [key for key in known if key not in files]
+        for review_set, cochrane_id in removed:
+            self.remove(review_set, cochrane_id)
+        return imported, len(removed)
+
+    def version(self):
+        # Changes with every import or removal (hash of the file index), e.g. as cache key of data derived from the store
+        with self.lock:
+            rows = self.db.execute("SELECT review_set, cochrane_id, mtime, size FROM manual_files ORDER BY review_set, cochrane_id").fetchall()
+        return hashlib.sha256(repr(rows).encode()).hexdigest()
+
+    def ids(self, review_set):
+        with self.lock:
+            return np.array([row[0] for row in self.db.execute("SELECT cochrane_id FROM manual_files WHERE review_set = ? ORDER BY cochrane_id", (review_set,))], dtype=object)
+
+    def outcomes(self, cochrane_id, review_set):
+        # Outcomes in file order (manual_extraction_columns only), missing values as NaN (not None) as with pd.read_csv
+        with self.lock:
+            manual_sof_df = pd.read_sql_query(f"SELECT {', '.join(manual_extraction_columns)} FROM manual_sof WHERE cochrane_id = ? AND review_set = ? ORDER BY rowid", self.db, params=(cochrane_id, review_set))
+        manual_sof_df = manual_sof_df.astype({column: float for column, type in manual_extraction_columns.items() if type == "REAL"})
+        return manual_sof_df.where(manual_sof_df.notna(), np.nan)
+
+    def __getitem__(self, cochrane_id):
+        # From the manual extraction folder itself if the review is also in test/
+        with self.lock:
+            review_set = self.db.execute("SELECT review_set FROM manual_files WHERE cochrane_id = ? AND review_set != 'excluded' ORDER BY review_set = 'test'", (cochrane_id,)).fetchone()
+        if not review_set:
+            raise KeyError(cochrane_id)
+        return self.outcomes(cochrane_id, review_set[0])
+
+    def export_csv(self, path):
+        # Writes the per-review CSVs of the manual extraction folder (included and test, in the download format of the manual checks dashboard)
+        for review_set, folder in (("included", path), ("test", f"{path}test/")):
+            os.makedirs(folder, exist_ok=True)
+            for cochrane_id in self.ids(review_set):
+                self.outcomes(cochrane_id, review_set).to_csv(f"{folder}{cochrane_id}.csv", index=False)
+
+    def close(self):
+        self.db.close()
+
+def normalize_sof_html(html_content):
+    # Replace non-breaking spaces for consistency (used inconsistently)
+    html_content = html_content.replace('\xa0', ' ')
+    # Replace all th with td for consistency (used inconsistently)
+    html_content = html_content.replace('<th', '<td')
+    html_content = html_content.replace('</th', '</td')
+    # Convert superscript digits
+    html_content = re.sub(r'(?<=<sup>)([\d,]+)(?=</sup>)', lambda m: ''.join(['⁰¹²³⁴⁵⁶⁷⁸⁹'[int(d)] if d.isdigit() else ' ' for d in m.group(0)]), html_content)
+    return html_content
+
+def sof_soup(html_content):
+    # bs4 is only needed for parsing, not for the dashboards importing functions.py
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(normalize_sof_html(html_content), 'html.parser')
+
+class ColumnAccumulator:
+    # Collects rows column-wise (list.extend per column: amortized O(1) per row, instead of copying a growing list of row lists)
+    # and materializes the DataFrame only once at the end
+    def __init__(self, columns):
+        self.columns = {column: [] for column in columns}
+
+    def append(self, df):
+        for column, values in self.columns.items():
+            values.extend(df[column].tolist())
+
+    def append_row(self, row):
+        for column, values in self.columns.items():
+            values.append(row[column])
+
+    def extend(self, other):
+        for column, values in self.columns.items():
+            values.extend(other.columns[column])
+
+    def __len__(self):
+        return len(next(iter(self.columns.values())))
+
+    def to_df(self):
+        return pd.DataFrame(self.columns)
+
+def parse_review_sof_tables(id, html_content):
+    # (tables, outcomes) of the compact model: the title and header columns once per table, the outcomes with (cochrane_id, table_nr)
+    soup = sof_soup(html_content)
+
+    tables_data = ColumnAccumulator(sof_table_columns)
+    data = ColumnAccumulator(sof_outcome_columns)
+
+    # Loop over SOF-Tables to extract information
+    tables = soup.find_all('table', class_='summary-of-findings')
+    for table_nr in range(len(tables)):
+        table = tables[table_nr]
+
+        result_tuple = table_merged_df(table)
+        if not result_tuple:
+            continue
+        table_title, header_rows, footer_rows, table_df, merged_df = result_tuple
+
+        # Get columns
+        rownames_col, relative_effects_col, nr_participants_studies_col, certainty_col = get_columns(merged_df)
+
+        merged_df['NA'] = 'NA'
+
+        # Only look at important columns
+        sof_df = merged_df[[rownames_col, relative_effects_col, nr_participants_studies_col, certainty_col]]
+        sof_df.columns = ['rowname', 'relative_effects', 'nr_participants_studies', 'certainty']
+        sof_df = sof_df.drop_duplicates() # Some rows are now duplicated, mostly because they used to have multiple sub-rows in "Illustrative comparative rates"
+
+        sof_df['cochrane_id'] = id
+        sof_df['table_nr'] = table_nr + 1
+        sof_df['row_nr'] = list(range(1, sof_df.shape[0]+1))
+
+        data.append(sof_df)
+        tables_data.append_row({'cochrane_id': id, 'table_nr': table_nr + 1, 'table_title': table_title, 'rownames_col': rownames_col,
+                                'relative_effects_col': relative_effects_col, 'nr_participants_studies_col': nr_participants_studies_col, 'certainty_col': certainty_col})
+
+    return tables_data, data
+
+def parse_review_sof_tables_chunk(chunk):
+    # Runs in a worker process: exceptions are returned with the cochrane_id instead of aborting the whole run
+    # Also returns the get_columns_memo hits and misses of this chunk (the memo of a worker process is not visible to the caller)
+    hits, misses = get_columns_memo.hits, get_columns_memo.misses
+    results = []
+    for id, html_content in chunk:
+        try:
+            results.append((id, parse_review_sof_tables(id, html_content), None))
+        except Exception as e:
+            results.append((id, (ColumnAccumulator(sof_table_columns), ColumnAccumulator(sof_outcome_columns)), repr(e)))
+    return results, (get_columns_memo.hits - hits, get_columns_memo.misses - misses)
+
+def parser_fingerprint():
+    # Changes whenever the code (or library versions) that turn one review's SoF html into its combined_sof_df rows change
+    import inspect
+    import bs4
+    parts = [inspect.getsource(function) for function in (normalize_sof_html, sof_soup, parse_review_sof_tables, table_merged_df, read_table_rows, row_values, merge_first_columns, is_plain_table, table_grid, cell_text, grid_df, get_column_positions, get_columns)]
+    parts += [number, participants, studies, rownames_nr_participants_studies_re.pattern, str(flags), str(sof_table_columns), str(sof_outcome_columns), pd.__version__, bs4.__version__]
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+class ParseCache:
+    # Per-review (tables, outcomes) fragments in sqlite, valid as long as the normalized SoF html and the parser_fingerprint are unchanged
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS parse_cache (cochrane_id TEXT PRIMARY KEY, html_hash TEXT, parser_fingerprint TEXT, data BLOB, error TEXT)")
+        self.db.commit()
+        self.parser_fingerprint = parser_fingerprint()
+
+    @staticmethod
+    def html_hash(html_content):
+        return hashlib.sha256(normalize_sof_html(html_content).encode()).hexdigest()
+
+    def get_many(self, html_hashes):
+        # html_hashes: dict cochrane_id -> html_hash. Returns dict cochrane_id -> ((tables, outcomes) ColumnAccumulators, error) for valid entries
+        hits = {}
+        # Failed reviews are always parsed again (entries with an error of older runs are skipped)
+        for id, html_hash, data, error in self.db.execute("SELECT cochrane_id, html_hash, data, error FROM parse_cache WHERE parser_fingerprint = ? AND error IS NULL", (self.parser_fingerprint,)):
+            if html_hashes.get(id) == html_hash:
+                review_tables, review_data = ColumnAccumulator(sof_table_columns), ColumnAccumulator(sof_outcome_columns)
+                review_tables.columns, review_data.columns = pickle.loads(data)
+                hits[id] = ((review_tables, review_data), error)
+        return hits
+
+    def put_many(self, results):
+        # results: list of (cochrane_id, html_hash, (tables, outcomes) ColumnAccumulators, error), only results without error are stored
+        self.db.executemany("INSERT OR REPLACE INTO parse_cache VALUES (?, ?, ?, ?, ?)", ((id, html_hash, self.parser_fingerprint, pickle.dumps((review_tables.columns, review_data.columns)), error) for id, html_hash, (review_tables, review_data), error in results if not error))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+def chunked(iterable, chunksize):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def ordered_map(executor, function, iterable, max_pending):
+    # Like executor.map (results in input order), but with at most max_pending tasks submitted ahead, so the inputs are read lazily
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def parse_sof_tables(sof_tables, n_jobs=1, chunksize=16, cache=None, compact=False):
+    # sof_tables: Series cochrane_id -> SoF html or a SofHtmlStore (streamed, the html of all reviews is never in memory at once).
+    # Returns combined_sof_df (same order as serially; compact=True: (sof_tables_df, outcomes_df), see split_sof_tables) and a list of (cochrane_id, error)
+    # With a ParseCache, only reviews whose html or parser code changed are parsed again
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm
+
+    ids = list(sof_tables.keys())
+    cached = {}
+    if cache:
+        # A SofHtmlStore has the hashes stored, so only the reviews to parse are decompressed
+        html_hashes = sof_tables.html_hashes() if isinstance(sof_tables, SofHtmlStore) else {id: cache.html_hash(html_content) for id, html_content in sof_tables.items()}
+        cached = cache.get_many(html_hashes)
+        print(f"Parse cache: {len(cached)} of {len(ids)} reviews unchanged")
+    if isinstance(sof_tables, SofHtmlStore):
+        items_to_parse = sof_tables.subset([id for id in ids if id not in cached]).items()
+    else:
+        items_to_parse = ((id, html_content) for id, html_content in sof_tables.items() if id not in cached)
+
+    chunks = chunked(items_to_parse, chunksize)
+    executor = None
+    if n_jobs == 1:
+        chunk_results = map(parse_review_sof_tables_chunk, chunks)
+    else:
+        # fork avoids re-running the calling script in every worker (spawn is the default on macOS / Windows)
+        mp_context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+        executor = ProcessPoolExecutor(n_jobs, mp_context=mp_context)
+        # Results in input order, so the output is identical to the serial run
+        chunk_results = ordered_map(executor, parse_review_sof_tables_chunk, chunks, max_pending=4 * n_jobs)
+
+    parsed = {}
+    header_hits, header_misses = 0, 0
+    try:
+        with tqdm(total=len(ids) - len(cached)) as progress:
+            for results, (hits, misses) in chunk_results:
+                header_hits += hits
+                header_misses += misses
+                for id, review_data, error in results:
+                    parsed[id] = (review_data, error)
+                if cache:
+                    cache.put_many([(id, html_hashes[id], review_data, error) for id, review_data, error in results])
+                progress.update(len(results))
+    finally:
+        # Also on a BrokenProcessPool, KeyboardInterrupt or failing cache write: pending chunks are cancelled and the workers stopped
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    if header_hits + header_misses:
+        print(f"Header cache (get_columns): {header_hits} hits, {header_misses} misses ({header_hits / (header_hits + header_misses):.1%} of tables with a known header layout)")
+
+    tables_data = ColumnAccumulator(sof_table_columns)
+    data = ColumnAccumulator(sof_outcome_columns)
+    errors = []
+    for id in ids:
+        (review_tables, review_data), error = cached[id] if id in cached else parsed[id]
+        tables_data.extend(review_tables)
+        data.extend(review_data)
+        if error:
+            errors.append((id, error))
+    sof_tables_df, outcomes_df = categorize_sof_tables(tables_data.to_df(), data.to_df())
+    return (sof_tables_df, outcomes_df) if compact else join_sof_tables(sof_tables_df, outcomes_df), errors
+
+# Extraction plan for extract_relative_effects_numbers_quality: every pattern is compiled once here
+grade = ["verylw", "low", "moderate", "high"]
+grade_re = [(g, re.compile(rf"\b{g}")) for g in grade] # leading \b is important (e.g. "follow"), but following \b is not suitable because of superscript letters immediately afterwards ("e.g. lowa,b,c")
+
+# Remove thousands separators . and , and ' (don't remove thousands searator space " ", because otherwise e.g. in CD008649.PUB4, "22 1 study" will be converted to "221 study")
+# and convert written numbers 1-9 to digits
+# and remove superscript digits (e.g. CD008649.PUB4)
+# and remove single letters after numbers (which were most likely superscript letters) (e.g. CD008774.PUB2)
+# and remove trailing N=
+nr_participants_studies_replacements = [(re.compile(pattern, flags), replacement) for pattern, replacement in [
+    (r"\b(\d+)\.(\d+)\b", r'\1\2'),
+    (r"\b(\d+),(\d+)\b", r'\1\2'),
+    (r"\b(\d+)'(\d+)\b", r'\1\2'),
+    (r'\bone\b', '1'), (r'\btwo\b', '2'), (r'\bthree\b', '3'), (r'\bfour\b', '4'), (r'\bfive\b', '5'), (r'\bsix\b', '6'), (r'\bseven\b', '7'), (r'\beight\b', '8'), (r'\bnine\b', '9'),
+    (r'[⁰¹²³⁴⁵⁶⁷⁸⁹]*', ''),
+    (r'(\d+)[a-zA-Z*](?:,[a-zA-Z*])*\b', r'\1'),
+    (r'N\s*=\s*', ''),
+]]
+# Single-pass version of nr_participants_studies_replacements: one compiled alternation, dispatched by the matching group
+number_words = {"one": "1", "two": "2", "three": "3", "four": "4", "five": "5", "six": "6", "seven": "7", "eight": "8", "nine": "9"}
+nr_participants_studies_token_re = re.compile(rf"\b(\d+)[.,'](\d+)\b|\b({'|'.join(number_words)})\b|(\d+)[a-zA-Z*](?:,[a-zA-Z*])*\b|N\s*=\s*", flags)
+# Where one replacement of the chain can create a match for a later one (superscripts between tokens, "*" after a joined number, 1.234,5), only the chain gives the same result
+nr_participants_studies_chain_re = re.compile(r"[⁰¹²³⁴⁵⁶⁷⁸⁹*]|\d[.,']\d+[.,']\d")
+
+def nr_participants_studies_token(match):
+    if match.group(1) is not None:
+        return match.group(1) + match.group(2)
+    if match.group(3) is not None:
+        return number_words[match.group(3).casefold()]
+    if match.group(4) is not None:
+        return match.group(4)
+    return ""
+
+def normalize_nr_participants_studies(x):
+    if not isinstance(x, str):
+        return np.nan
+    if nr_participants_studies_chain_re.search(x):
+        for pattern, replacement in nr_participants_studies_replacements:
+            x = pattern.sub(replacement, x)
+        return x
+    return nr_participants_studies_token_re.sub(nr_participants_studies_token, x)
+
+def benchmark_nr_participants_studies_normalization(values, n=5):
+    # Compare the .str.replace chain and normalize_nr_participants_studies on values (e.g. combined_sof_df["nr_participants_studies"]), check that both give identical output
+    values = pd.Series(values, dtype=object)
+    timings = {}
+    results = {}
+    for name, normalize in [
+        ("replace chain", lambda values: replace_all(values, nr_participants_studies_replacements)),
+        ("single pass", lambda values: values.map(normalize_nr_participants_studies)),
+    ]:
+        start = time.perf_counter()
+        for _ in range(n):
+            results[name] = normalize(values)
+        timings[name] = (time.perf_counter() - start) / n
+    pd.testing.assert_series_equal(results["replace chain"], results["single pass"])
+    print(f"{len(values)} values: replace chain {timings['replace chain'] * 1000:.1f}ms, single pass {timings['single pass'] * 1000:.1f}ms ({timings['replace chain'] / timings['single pass']:.1f}x)")
+    return timings
+
+relative_effects_replacements = [(re.compile(pattern, flags), replacement) for pattern, replacement in [
+    (r"95%\s*CI:?\s*", ""),
+    (r"\s*CI:?\s*", ""),
+    (r'[⁰¹²³⁴⁵⁶⁷⁸⁹]*', ''),
+    (r'(\d+)[a-zA-Z*](?:,[a-zA-Z*])*\b', r'\1'),
+]]
+effect_type_cleaned = {
+    "hazard ratio": "HR",
+    "odds ratio": "OR",
+    "relative risk": "RR", # doesn't seem to occur
+    "risk ratio": "RR",
+    "rate ratio": "RR",
+}
+#effect_type = r"Rate ratio|Risk ratio|RR|Adjusted RR|Reported adjusted RR|aRR|Odds Ratio|OR|Adjusted OR|Reported adjusted OR|aOR|Peto OR|POR|Hazard ratio|HR|Adjusted HR|aHR|Incidence rate ratio|IRR|Adjusted IRR|aIRR"
+#re_str = rf"({effect_type}):?\s*\[?(\d+\.?\d*)\]?\s*\((?:95% ?CI )?\[?(\d+\.?\d*)\]?(?:\s*to\s*)?(?:,\s*)?\[?(\d+\.?\d*)\]?\)"
+effect_type_full_re_str = rf"{'|'.join(effect_type_cleaned.keys())}"
+effect_type_acronym_re_str = rf"{'|'.join(effect_type_cleaned.values())}" # acronyms should be case sensitive because of lower case "or" in many columns
+effect_type_re_str = rf"({effect_type_full_re_str}|{effect_type_acronym_re_str})"
+# Unfortunately this regex misses cases without decimal, e.g. RR 1.2 (0 to 2.4)
+point_estimate_and_ci_re_str = r"\[?(\d+\.\d*)\]?[,;]?\s*\(?\[?(\d+\.\d*)\]?(?:\s*to\s*)?(?:,\s*)?\[?(\d+\.\d*)\]?"
+# effect_type is in each cell
+re_str = rf"{effect_type_re_str}:?\s*{point_estimate_and_ci_re_str}"
+
+# Patterns matched against the free-text cells in parse_nr_participants_studies and parse_relative_effects: name -> (pattern, flags)
+# Audit: none needs backreferences or look-arounds, so all of them compile on RE2 (linear time). On re, long cells can backtrack badly in
+# participants_studies_col / studies_participants_col (.+\s*.* between two alternations) and point_estimate_and_ci / effect_type_point_estimate_and_ci (adjacent optional groups around \d+\.\d*)
+free_text_patterns = {
+    "all_numbers": (r'(\d+)', re.MULTILINE),
+    "first_number": (r'(\d+)', flags),
+    "participants_studies_col": (rf"{participants}.+\s*.*{studies}", flags),
+    "studies_participants_col": (rf"{studies}.+\s*.*{participants}", flags),
+    "participants_studies": (rf'^(\d+)\b\s*{participants}?[\s([,:]+\b(\d+)', flags),
+    "studies_participants": (rf'^(\d+)\b\s*{studies}?[\s([,:]+\b(\d+)', flags),
+    "nr_participants": (rf'(\d+)\s?{participants}', flags),
+    "nr_studies": (rf'(\d+)\s?{studies}', flags),
+    "number_participants": (rf'{number}{participants}(\d+)', flags),
+    "participants_col": (rf"^{number}?{participants}", flags),
+    "studies_col": (rf"^{number}?{studies}", flags),
+    "only_number": (r'^\d+$', flags),
+    "number_bracket": (r'^\d+\s*\(', flags),
+    "leading_number": (r'^(\d+)', flags),
+    "effect_type_point_estimate_and_ci": (re_str, flags),
+    "point_estimate_and_ci": (point_estimate_and_ci_re_str, flags),
+    "effect_type_full": (f"({effect_type_full_re_str})", flags), # effect_type_full_re_str is not case sensitive
+    "effect_type_acronym": (f"({effect_type_acronym_re_str})", re.MULTILINE), # effect_type_acronym_re_str is case sensitive
+}
+
+def compile_pattern(pattern, pattern_flags=0, re2=None):
+    # With the re2 module (pip install google-re2), compile for RE2 (linear time matching); its \d, \w, \b and \s are ASCII only,
+    # so results can differ from re on non-ASCII text. Falls back to re if RE2 can't compile the pattern
+    if re2:
+        options = re2.Options()
+        options.log_errors = False
+        inline_flags = "".join(flag for re_flag, flag in [(re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s")] if pattern_flags & re_flag)
+        try:
+            return re2.compile(f"(?{inline_flags}){pattern}" if inline_flags else pattern, options)
+        except re2.error:
+            print(f"RE2 can't compile {pattern!r}, using re")
+    return re.compile(pattern, pattern_flags)
+
+@functools.lru_cache()
+def compiled_free_text_patterns(use_re2=False):
+    re2 = None
+    if use_re2:
+        try:
+            import re2
+        except ImportError:
+            print("google-re2 is not installed, using re")
+    return {name: compile_pattern(pattern, pattern_flags, re2) for name, (pattern, pattern_flags) in free_text_patterns.items()}
+
+# Cell-wise counterparts of .str.contains, .str.extract and .str.extractall(...).groupby(level=0).size() that work with re and RE2 patterns
+def str_contains(series, pattern):
+    return pd.Series([isinstance(x, str) and pattern.search(x) is not None for x in series], index=series.index, dtype=bool)
+
+def str_extract(series, pattern):
+    no_match = (np.nan,) * pattern.groups
+    rows = []
+    for x in series:
+        match = pattern.search(x) if isinstance(x, str) else None
+        rows.append(tuple(np.nan if group is None else group for group in match.groups()) if match else no_match)
+    return pd.DataFrame(rows, index=series.index, columns=range(pattern.groups), dtype=object)
+
+def str_count(series, pattern):
+    return pd.Series([len(pattern.findall(x)) if isinstance(x, str) else 0 for x in series], index=series.index, dtype=np.int64)
+
+class CellTimeout(Exception):
+    pass
+
+@contextmanager
+def time_limit(seconds):
+    # Raises CellTimeout after seconds (SIGALRM, so only on POSIX and in the main thread; elsewhere there is no limit)
+    if not seconds or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    def handler(signum, frame):
+        raise CellTimeout()
+    previous_handler = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+# (cochrane_id, cell values) of cells that exceeded the time limit in guarded_parse
+pathological_cells = []
+
+def guarded_parse(parse, df, ids, cell_timeout=5, chunksize=256):
+    # Runs parse on chunks of df, each within cell_timeout seconds. Chunks that time out are parsed cell by cell,
+    # and cells that still time out are logged and parsed as missing values, so one bad review can't stall a full-corpus run
+    parsed = []
+    for start in range(0, len(df), chunksize):
+        chunk = df.iloc[start:start+chunksize]
+        try:
+            with time_limit(cell_timeout):
+                parsed.append(parse(chunk.copy()))
+            continue
+        except CellTimeout:
+            pass
+        for i in range(len(chunk)):
+            cell = chunk.iloc[i:i+1]
+            try:
+                with time_limit(cell_timeout):
+                    parsed.append(parse(cell.copy()))
+            except CellTimeout:
+                values = cell.iloc[0].to_dict()
+                print(f"Regex time limit ({cell_timeout}s) exceeded, parsed as missing. ID: {ids[start + i]}. Cell: {str(values)[:200]}")
+                pathological_cells.append((ids[start + i], values))
+                parsed.append(parse(pd.DataFrame(np.nan, index=cell.index, columns=cell.columns, dtype=object)))
+    return pd.concat(parsed)
+
+def replace_all(series, replacements):
+    for pattern, replacement in replacements:
+        series = series.str.replace(pattern, replacement, regex=True)
+    return series
+
+def memoized_parse(df, key_columns, result_dtypes, parse, memo, cell_timeout=None):
+    # Run parse only on the distinct key tuples of df that are not in memo and scatter the results back to all rows by code
+    # With cell_timeout, parse runs in guarded_parse
+    codes = np.zeros(len(df), dtype=np.int64)
+    for column in key_columns:
+        column_codes, column_uniques = pd.factorize(df[column], use_na_sentinel=False)
+        codes = codes * len(column_uniques) + column_codes
+    codes, unique_codes = pd.factorize(codes)
+    first_positions = np.empty(len(unique_codes), dtype=np.int64)
+    first_positions[codes[::-1]] = np.arange(len(codes))[::-1]
+    unique_df = df[key_columns].iloc[first_positions].astype(object).reset_index(drop=True)
+    keys = [tuple(None if pd.isna(v) else v for v in key) for key in unique_df.itertuples(index=False, name=None)]
+
+    results = [memo.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        if cell_timeout:
+            ids = df["cochrane_id"].iloc[first_positions[missing]].to_list() if "cochrane_id" in df else [None] * len(missing)
+            parsed = guarded_parse(parse, unique_df.iloc[missing].reset_index(drop=True), ids, cell_timeout)[list(result_dtypes)]
         else:
-            return "NA"
-    combined_sof_df["certainty_cleaned"] = combined_sof_df["certainty"].apply(match_grade)
+            parsed = parse(unique_df.iloc[missing].reset_index(drop=True))[list(result_dtypes)]
+        for i, result in zip(missing, parsed.itertuples(index=False, name=None)):
+            results[i] = result
+            memo[keys[i]] = result
+
+    unique_results = pd.DataFrame(results, columns=list(result_dtypes)).astype(result_dtypes)
+    for column in result_dtypes:
+        df[column] = unique_results[column].to_numpy()[codes]
+    return df
+
+def match_grade(x):
+    x= str(x).lower()
+    x= x.replace("high risk", "") # CD003010.PUB5
+    x= x.replace("high cardiovascular risk", "")
+    x= x.replace("verylow", "very low") # CD008649.PUB4
+    x= x.replace("m oderate", "moderate") # CD007880.PUB3
+    x= x.replace("l ow", "low") # CD004711.PUB3
+    x= x.replace("very low", "verylw") # to differentiate very low and low
+    #matches = [g for g in grade if g in x]
+    matches = [g for g, g_re in grade_re if g_re.search(x)]
+    if len(matches) >= 1:
+        if matches[0] == "verylw":
+            matches[0] = "very low"
+        return ",".join(matches)
+    else:
+        return "NA"
+
+def parse_certainty(df):
+    # Extract certainty_cleaned
+    df["certainty_cleaned"] = df["certainty"].apply(match_grade)
 
-    # combined_sof_df["certainty_cleaned"] = pd.Categorical(
-    #     combined_sof_df["certainty_cleaned"], 
+    # df["certainty_cleaned"] = pd.Categorical(
+    #     df["certainty_cleaned"], 
     #     categories=["very low", "low", "moderate", "high"],
     #     ordered=True
     # )
+    return df
 
+def parse_nr_participants_studies(df, use_re2=False):
+    patterns = compiled_free_text_patterns(use_re2)
     # Extract nr_participants_cleaned, nr_studies_cleaned
-    # Remove thousands separators . and , and ' (don't remove thousands searator space " ", because otherwise e.g. in CD008649.PUB4, "22 1 study" will be converted to "221 study")
-    # and convert written numbers 1-9 to digits
-    # and remove superscript digits (e.g. CD008649.PUB4)
-    # and remove single letters after numbers (which were most likely superscript letters) (e.g. CD008774.PUB2)
-    # and remove trailing N=
-    combined_sof_df["nr_participants_studies_cleaned"] = combined_sof_df["nr_participants_studies"].\
-        str.replace(r"\b(\d+)\.(\d+)\b", r'\1\2', regex=True, flags=flags).\
-        str.replace(r"\b(\d+),(\d+)\b", r'\1\2', regex=True, flags=flags).\
-        str.replace(r"\b(\d+)'(\d+)\b", r'\1\2', regex=True, flags=flags).\
-        str.replace(r'\bone\b', '1', regex=True, flags=flags).str.replace(r'\btwo\b', '2', regex=True, flags=flags).str.replace(r'\bthree\b', '3', regex=True, flags=flags).str.replace(r'\bfour\b', '4', regex=True, flags=flags).str.replace(r'\bfive\b', '5', regex=True, flags=flags).str.replace(r'\bsix\b', '6', regex=True, flags=flags).str.replace(r'\bseven\b', '7', regex=True, flags=flags).str.replace(r'\beight\b', '8', regex=True, flags=flags).str.replace(r'\bnine\b', '9', regex=True, flags=flags).\
-        str.replace(r'[⁰¹²³⁴⁵⁶⁷⁸⁹]*', '', regex=True, flags=flags).\
-        str.replace(r'(\d+)[a-zA-Z*](?:,[a-zA-Z*])*\b', r'\1', regex=True, flags=flags).\
-        str.replace(r'N\s*=\s*', '', regex=True, flags=flags)
-    nr_participants_studies_all_numbers = combined_sof_df["nr_participants_studies_cleaned"].str.extractall(r'(\d+)', re.MULTILINE)
-    combined_sof_df["nr_participants_studies_col_nr_of_nr"] = nr_participants_studies_all_numbers.groupby(level=0).size().reindex(combined_sof_df.index, fill_value=0)
-    
+    df["nr_participants_studies_cleaned"] = df["nr_participants_studies"].map(normalize_nr_participants_studies)
+    # Each mask and extract below is computed once per column and reused
+    nr_participants_studies_cleaned = df["nr_participants_studies_cleaned"]
+    nr_participants_studies_col = df["nr_participants_studies_col"]
+    df["nr_participants_studies_col_nr_of_nr"] = str_count(nr_participants_studies_cleaned, patterns["all_numbers"])
+    two_numbers = df["nr_participants_studies_col_nr_of_nr"] == 2
+    # A match of these patterns always fills all groups, so "contains" is the same as a non-missing first group
+    participants_studies = str_extract(nr_participants_studies_cleaned, patterns["participants_studies"]).astype(float)
+    studies_participants = str_extract(nr_participants_studies_cleaned, patterns["studies_participants"]).astype(float)
+    leading_number = str_extract(nr_participants_studies_cleaned, patterns["leading_number"])[0].astype(float)
+    only_number_or_number_bracket = str_contains(nr_participants_studies_cleaned, patterns["only_number"]) | str_contains(nr_participants_studies_cleaned, patterns["number_bracket"])
+    df["nr_participants_cleaned"] = np.nan
+    df["nr_studies_cleaned"] = np.nan
+
     # extract nr_participants_cleaned and nr_studies_cleaned together
     # extract 0 cases
-    combined_sof_df.loc[\
-        (combined_sof_df["nr_participants_studies_col_nr_of_nr"] == 1) & \
-        (combined_sof_df["nr_participants_studies_cleaned"].str.extract(r'(\d+)', flags=flags)[0].astype(float)==0), \
+    df.loc[\
+        (df["nr_participants_studies_col_nr_of_nr"] == 1) & \
+        (str_extract(nr_participants_studies_cleaned, patterns["first_number"])[0].astype(float)==0), \
         ["nr_participants_cleaned", "nr_studies_cleaned"]] = 0
 
     # most common: nr_participants_studies_col mentions participants and studies in this order (>2/3 of PICOs)
-    combined_sof_df.loc[\
-        (combined_sof_df["nr_participants_studies_col_nr_of_nr"] == 2) & \
-        combined_sof_df["nr_participants_studies_col"].str.contains(rf"{participants}.+\s*.*{studies}", flags=flags) & \
-        combined_sof_df["nr_participants_studies_cleaned"].str.contains(rf'^(\d+)\b\s*{participants}?[\s([,:]+\b(\d+)', flags=flags), \
+    df.loc[\
+        two_numbers & \
+        str_contains(nr_participants_studies_col, patterns["participants_studies_col"]) & \
+        participants_studies[0].notna(), \
         ["nr_participants_cleaned", "nr_studies_cleaned"]] = \
-        combined_sof_df["nr_participants_studies_cleaned"].str.extract(rf'^(\d+)\b\s*{participants}?[\s([,:]+\b(\d+)', flags=flags).astype(float).rename({0: "nr_participants_cleaned", 1: "nr_studies_cleaned"}, axis=1)
+        participants_studies.rename({0: "nr_participants_cleaned", 1: "nr_studies_cleaned"}, axis=1)
     # much rarer: nr_participants_studies_col mentions studies and participants in this (reversed) order
-    combined_sof_df.loc[\
-        (combined_sof_df["nr_participants_cleaned"].isna() & combined_sof_df["nr_studies_cleaned"].isna()) & \
-        (combined_sof_df["nr_participants_studies_col_nr_of_nr"] == 2) & \
-        combined_sof_df["nr_participants_studies_col"].str.contains(rf"{studies}.+\s*.*{participants}", flags=flags) & \
-        combined_sof_df["nr_participants_studies_cleaned"].str.contains(rf'^(\d+)\b\s*{studies}?[\s([,:]+\b(\d+)', flags=flags), \
+    df.loc[\
+        (df["nr_participants_cleaned"].isna() & df["nr_studies_cleaned"].isna()) & \
+        two_numbers & \
+        str_contains(nr_participants_studies_col, patterns["studies_participants_col"]) & \
+        studies_participants[0].notna(), \
         ["nr_studies_cleaned", "nr_participants_cleaned"]] = \
-        combined_sof_df["nr_participants_studies_cleaned"].str.extract(rf'^(\d+)\b\s*{studies}?[\s([,:]+\b(\d+)', flags=flags).astype(float).rename({0: "nr_studies_cleaned", 1: "nr_participants_cleaned"}, axis=1)
+        studies_participants.rename({0: "nr_studies_cleaned", 1: "nr_participants_cleaned"}, axis=1)
 
     # nr_participants_cleaned and nr_studies_cleaned separately
-    combined_sof_df["nr_participants_cleaned"] = \
-        combined_sof_df["nr_participants_cleaned"].fillna(combined_sof_df["nr_participants_studies_cleaned"].str.extract(rf'(\d+)\s?{participants}', flags=flags, expand=False).astype(float))
-    combined_sof_df["nr_studies_cleaned"] = \
-        combined_sof_df["nr_studies_cleaned"].fillna(combined_sof_df["nr_participants_studies_cleaned"].str.extract(rf'(\d+)\s?{studies}', flags=flags, expand=False).astype(float))
+    df["nr_participants_cleaned"] = \
+        df["nr_participants_cleaned"].fillna(str_extract(nr_participants_studies_cleaned, patterns["nr_participants"])[0].astype(float))
+    df["nr_studies_cleaned"] = \
+        df["nr_studies_cleaned"].fillna(str_extract(nr_participants_studies_cleaned, patterns["nr_studies"])[0].astype(float))
 
     # Where the format is "Number of participants: x (y studies)" => y would have been picked up above, but x not (mostly if not exclusively for cases where rownames_col == nr_participants_studies_col)
-    combined_sof_df.loc[\
-        combined_sof_df["nr_participants_cleaned"].isna() & \
-        combined_sof_df["nr_participants_studies_cleaned"].str.contains(rf"{number}{participants}(\d+)", flags=flags), \
+    number_participants = str_extract(nr_participants_studies_cleaned, patterns["number_participants"])[0].astype(float)
+    df.loc[\
+        df["nr_participants_cleaned"].isna() & \
+        number_participants.notna(), \
         "nr_participants_cleaned"] = \
-        combined_sof_df["nr_participants_studies_cleaned"].str.extract(rf'{number}{participants}(\d+)', flags=flags, expand=False).astype(float)
+        number_participants
 
     # For cases where column title is only "No of participants" but format is actually "x (y studies)" => y would have been picked up above, but x not
-    combined_sof_df.loc[\
-        combined_sof_df["nr_participants_cleaned"].isna() & \
-        combined_sof_df["nr_participants_studies_col"].str.contains(rf"^{number}?{participants}", flags=flags) & \
-        (combined_sof_df["nr_participants_studies_cleaned"].str.contains(r'^\d+$', flags=flags) | combined_sof_df["nr_participants_studies_cleaned"].str.contains(r'^\d+\s*\(', flags=flags)), \
+    df.loc[\
+        df["nr_participants_cleaned"].isna() & \
+        str_contains(nr_participants_studies_col, patterns["participants_col"]) & \
+        only_number_or_number_bracket, \
         "nr_participants_cleaned"] = \
-        combined_sof_df["nr_participants_studies_cleaned"].str.extract(r'^(\d+)', flags=flags, expand=False).astype(float)
+        leading_number
     # For cases where column title is only "No of studies" but format is actually "x (y participants)" => y would have been picked up above, but x not
-    combined_sof_df.loc[\
-        combined_sof_df["nr_studies_cleaned"].isna() & \
-        combined_sof_df["nr_participants_studies_col"].str.contains(rf"^{number}?{studies}", flags=flags) & \
-        (combined_sof_df["nr_participants_studies_cleaned"].str.contains(r'^\d+$', flags=flags) | combined_sof_df["nr_participants_studies_cleaned"].str.contains(r'^\d+\s*\(', flags=flags)), \
+    df.loc[\
+        df["nr_studies_cleaned"].isna() & \
+        str_contains(nr_participants_studies_col, patterns["studies_col"]) & \
+        only_number_or_number_bracket, \
         "nr_studies_cleaned"] = \
-        combined_sof_df["nr_participants_studies_cleaned"].str.extract(r'^(\d+)', flags=flags, expand=False).astype(float)
+        leading_number
         
     # If one is 0, so is the other
-    combined_sof_df.loc[(combined_sof_df["nr_studies_cleaned"] == 0) & combined_sof_df["nr_participants_cleaned"].isna(), "nr_participants_cleaned"] = 0
-    combined_sof_df.loc[(combined_sof_df["nr_participants_cleaned"] == 0) & combined_sof_df["nr_studies_cleaned"].isna(), "nr_studies_cleaned"] = 0
-
-    # Relative effects
-    combined_sof_df["relative_effects_cleaned"] = combined_sof_df["relative_effects"].\
-        str.replace(r"95%\s*CI:?\s*", "", regex=True, flags=flags).\
-        str.replace(r"\s*CI:?\s*", "", regex=True, flags=flags).\
-        str.replace(r'[⁰¹²³⁴⁵⁶⁷⁸⁹]*', '', regex=True, flags=flags).\
-        str.replace(r'(\d+)[a-zA-Z*](?:,[a-zA-Z*])*\b', r'\1', regex=True, flags=flags)
-    effect_type_cleaned = {
-        "hazard ratio": "HR",
-        "odds ratio": "OR",
-        "relative risk": "RR", # doesn't seem to occur
-        "risk ratio": "RR",
-        "rate ratio": "RR",
-    }
-    #effect_type = r"Rate ratio|Risk ratio|RR|Adjusted RR|Reported adjusted RR|aRR|Odds Ratio|OR|Adjusted OR|Reported adjusted OR|aOR|Peto OR|POR|Hazard ratio|HR|Adjusted HR|aHR|Incidence rate ratio|IRR|Adjusted IRR|aIRR"
-    #re_str = rf"({effect_type}):?\s*\[?(\d+\.?\d*)\]?\s*\((?:95% ?CI )?\[?(\d+\.?\d*)\]?(?:\s*to\s*)?(?:,\s*)?\[?(\d+\.?\d*)\]?\)"
-    effect_type_full_re_str = rf"{'|'.join(effect_type_cleaned.keys())}"
-    effect_type_acronym_re_str = rf"{'|'.join(effect_type_cleaned.values())}" # acronyms should be case sensitive because of lower case "or" in many columns
-    effect_type_re_str = rf"({effect_type_full_re_str}|{effect_type_acronym_re_str})"
-    # Unfortunately this regex misses cases without decimal, e.g. RR 1.2 (0 to 2.4)
-    point_estimate_and_ci_re_str = r"\[?(\d+\.\d*)\]?[,;]?\s*\(?\[?(\d+\.\d*)\]?(?:\s*to\s*)?(?:,\s*)?\[?(\d+\.\d*)\]?"
-    
-    # effect_type is in each cell
-    re_str = rf"{effect_type_re_str}:?\s*{point_estimate_and_ci_re_str}"
+    df.loc[(df["nr_studies_cleaned"] == 0) & df["nr_participants_cleaned"].isna(), "nr_participants_cleaned"] = 0
+    df.loc[(df["nr_participants_cleaned"] == 0) & df["nr_studies_cleaned"].isna(), "nr_studies_cleaned"] = 0
+    return df
 
-    combined_sof_df.loc[ \
-        combined_sof_df["relative_effects_cleaned"].astype(str).str.contains(re_str, flags=flags), \
-        ["effect_type", "point_estimate", "lower_ci", "upper_ci"]] = \
-        combined_sof_df["relative_effects_cleaned"].astype(str).str.extract(re_str, flags=flags).rename({0: "effect_type", 1: "point_estimate", 2: "lower_ci", 3: "upper_ci"}, axis=1)
+def parse_relative_effects(df, use_re2=False):
+    patterns = compiled_free_text_patterns(use_re2)
+    df["relative_effects_cleaned"] = replace_all(df["relative_effects"], relative_effects_replacements)
+    relative_effects_cleaned = df["relative_effects_cleaned"].astype(str)
+    relative_effects_col = df["relative_effects_col"].astype(str)
+    effect_type_point_estimate_and_ci = str_extract(relative_effects_cleaned, patterns["effect_type_point_estimate_and_ci"])
+    point_estimate_and_ci = str_extract(relative_effects_cleaned, patterns["point_estimate_and_ci"])
+    effect_type_full = str_extract(relative_effects_col, patterns["effect_type_full"])
+    effect_type_acronym = str_extract(relative_effects_col, patterns["effect_type_acronym"])
+    has_effect_type = effect_type_point_estimate_and_ci[0].notna()
+    has_effect_type_full = effect_type_full[0].notna()
+    # effect_type is in header only
+    header_only = ~has_effect_type & point_estimate_and_ci[0].notna()
+    df[["effect_type", "point_estimate", "lower_ci", "upper_ci"]] = pd.DataFrame(np.nan, index=df.index, columns=range(4), dtype=object)
+
+    # effect_type is in each cell
+    df.loc[has_effect_type, ["effect_type", "point_estimate", "lower_ci", "upper_ci"]] = \
+        effect_type_point_estimate_and_ci.rename({0: "effect_type", 1: "point_estimate", 2: "lower_ci", 3: "upper_ci"}, axis=1)
     
     # effect_type is in header only
-    combined_sof_df.loc[ \
-        ~combined_sof_df["relative_effects_cleaned"].astype(str).str.contains(re_str, flags=flags) & \
-        combined_sof_df["relative_effects_cleaned"].astype(str).str.contains(point_estimate_and_ci_re_str, flags=flags) & \
-        (combined_sof_df["relative_effects_col"].astype(str).str.contains(rf"{effect_type_full_re_str}", flags=flags) | \
-        combined_sof_df["relative_effects_col"].astype(str).str.contains(rf"{effect_type_acronym_re_str}", flags=re.MULTILINE)), \
-        ["point_estimate", "lower_ci", "upper_ci"]] = \
-        combined_sof_df["relative_effects_cleaned"].str.extract(point_estimate_and_ci_re_str, flags=flags).rename({0: "point_estimate", 1: "lower_ci", 2: "upper_ci"}, axis=1)
-    combined_sof_df.loc[ \
-        ~combined_sof_df["relative_effects_cleaned"].astype(str).str.contains(re_str, flags=flags) & \
-        combined_sof_df["relative_effects_cleaned"].astype(str).str.contains(point_estimate_and_ci_re_str, flags=flags) & \
-        combined_sof_df["relative_effects_col"].astype(str).str.contains(rf"{effect_type_full_re_str}", flags=flags), \
-        "effect_type"] = \
-        combined_sof_df["relative_effects_col"].astype(str).str.extract(f"({effect_type_full_re_str})", flags=flags).rename({0: "effect_type"}, axis=1) # effect_type_full_re_str is not case sensitive
-    combined_sof_df.loc[ \
-        ~combined_sof_df["relative_effects_cleaned"].astype(str).str.contains(re_str, flags=flags) & \
-        combined_sof_df["relative_effects_cleaned"].astype(str).str.contains(point_estimate_and_ci_re_str, flags=flags) & \
-        ~combined_sof_df["relative_effects_col"].astype(str).str.contains(rf"{effect_type_full_re_str}", flags=flags) & \
-        combined_sof_df["relative_effects_col"].astype(str).str.contains(rf"{effect_type_acronym_re_str}", flags=re.MULTILINE), \
-        "effect_type"] = \
-        combined_sof_df["relative_effects_col"].astype(str).str.extract(rf"({effect_type_acronym_re_str})", flags=re.MULTILINE).rename({0: "effect_type"}, axis=1) # effect_type_acronym_re_str is case sensitive
+    df.loc[header_only & (has_effect_type_full | effect_type_acronym[0].notna()), ["point_estimate", "lower_ci", "upper_ci"]] = \
+        point_estimate_and_ci.rename({0: "point_estimate", 1: "lower_ci", 2: "upper_ci"}, axis=1)
+    df.loc[header_only & has_effect_type_full, "effect_type"] = \
+        effect_type_full.rename({0: "effect_type"}, axis=1)
+    df.loc[header_only & ~has_effect_type_full & effect_type_acronym[0].notna(), "effect_type"] = \
+        effect_type_acronym.rename({0: "effect_type"}, axis=1)
 
     # Convert to float
-    combined_sof_df[["point_estimate", "lower_ci", "upper_ci"]] = combined_sof_df[["point_estimate", "lower_ci", "upper_ci"]].astype(float)
+    df[["point_estimate", "lower_ci", "upper_ci"]] = df[["point_estimate", "lower_ci", "upper_ci"]].astype(float)
 
     # Use only acronyms for effect_type
-    combined_sof_df["effect_type"] = combined_sof_df["effect_type"].str.lower()
-    combined_sof_df.loc[combined_sof_df["effect_type"].isin(effect_type_cleaned.keys()), "effect_type"] = \
-        combined_sof_df.loc[combined_sof_df["effect_type"].isin(effect_type_cleaned.keys()), "effect_type"].map(effect_type_cleaned)
-    combined_sof_df["effect_type"] = combined_sof_df["effect_type"].str.upper()
+    df["effect_type"] = df["effect_type"].str.lower()
+    df.loc[df["effect_type"].isin(effect_type_cleaned.keys()), "effect_type"] = \
+        df.loc[df["effect_type"].isin(effect_type_cleaned.keys()), "effect_type"].map(effect_type_cleaned)
+    df["effect_type"] = df["effect_type"].str.upper()
+    return df
+
+# Memo tables persist across calls, so repeated parser runs and dashboard edits reuse prior results (separately for re and RE2, whose results can differ)
+certainty_memo = LRUMemo()
+nr_participants_studies_memo = {False: LRUMemo(), True: LRUMemo()}
+relative_effects_memo = {False: LRUMemo(), True: LRUMemo()}
+
+def extract_relative_effects_numbers_quality(combined_sof_df, use_re2=False, cell_timeout=5, sof_tables_df=None):
+    # The free-text cells repeat a lot across outcomes, so each distinct value (or (header, value) pair) is parsed only once
+    # use_re2: match the free_text_patterns with RE2 (if installed); cell_timeout: seconds before a cell counts as pathological (see guarded_parse)
+    # With sof_tables_df, combined_sof_df is outcomes_df of the compact model (split_sof_tables): the header columns are only joined in for parsing
+    if sof_tables_df is not None:
+        df = join_sof_tables(sof_tables_df[["cochrane_id", "table_nr", "relative_effects_col", "nr_participants_studies_col"]], combined_sof_df)
+        df = extract_relative_effects_numbers_quality(df, use_re2, cell_timeout)
+        for column in df.columns.difference(combined_sof_df.columns, sort=False).drop(["relative_effects_col", "nr_participants_studies_col"]):
+            combined_sof_df[column] = df[column].to_numpy()
+        # Few distinct values: codes instead of a string per outcome
+        combined_sof_df[["effect_type", "certainty_cleaned"]] = combined_sof_df[["effect_type", "certainty_cleaned"]].astype("category")
+        return combined_sof_df
+    memoized_parse(combined_sof_df, ["certainty"], {
+        "certainty_cleaned": object,
+    }, parse_certainty, certainty_memo)
+    memoized_parse(combined_sof_df, ["nr_participants_studies_col", "nr_participants_studies"], {
+        "nr_participants_studies_cleaned": object,
+        "nr_participants_studies_col_nr_of_nr": np.int64,
+        "nr_participants_cleaned": float,
+        "nr_studies_cleaned": float,
+    }, functools.partial(parse_nr_participants_studies, use_re2=use_re2), nr_participants_studies_memo[use_re2], cell_timeout)
+    memoized_parse(combined_sof_df, ["relative_effects_col", "relative_effects"], {
+        "relative_effects_cleaned": object,
+        "effect_type": object,
+        "point_estimate": float,
+        "lower_ci": float,
+        "upper_ci": float,
+    }, functools.partial(parse_relative_effects, use_re2=use_re2), relative_effects_memo[use_re2], cell_timeout)
 
     return combined_sof_df
-# %%
-def create_box_pie_plot(combined_sof_df, showmeans=False):
-    certainty_levels = pd.Series(["very low", "low", "moderate", "high"])
-    certainty_levels = certainty_levels[certainty_levels.isin(combined_sof_df["certainty_cleaned"].unique())]
-    combined_sof_df["certainty_cleaned"] = pd.Categorical(
-        combined_sof_df["certainty_cleaned"], 
-        categories=certainty_levels,
-        ordered=True
+
+effect_size_cutoffs = {
+    "Very Large": 5,
+    "Large": 2,
+    "Medium": 1.5,
+    "Small": 1.2,
+    "Minimal": 1
+}
+
+def add_outcome_flags(final_sof_df):
+    # Filter columns of the cross-sectional dashboard derived from the relative effects
+    final_sof_df["has_relative_effect"] = final_sof_df["point_estimate"].notna()
+    final_sof_df["significant"] = (final_sof_df[["point_estimate", "lower_ci"]]>1).all(axis=1) | (final_sof_df[["point_estimate", "upper_ci"]]<1).all(axis=1)
+
+    # For dichotomous outcomes, in this case, one may consider rating down by two levels immediately if the ratio of the upper- to the lower-boundary of the CI is higher than 2.5 for odds ratios or 3.0 for relative risk ratios.
+    # https://usblog.gradeworkinggroup.org/2022/09/when-is-imprecision-very-serious-for.html
+    # Simulations conducted to inform GRADE guidance for addressing imprecision of dichotomous outcomes in the context of network meta-analysis provided insights into how many levels to rate down for imprecision in pairwise meta-analysis when considering the OIS [12]. These simulations suggested that when the ratio of the upper to the lower boundary of the CI is higher than 2.5 for odds ratios and three for RRs, the sample size is, for any reasonable combination of baseline risk and treatment effect, very far from meeting the OIS. Therefore, authors would not need to calculate the OIS and can rate down the certainty of evidence by two levels (Box 5, circumstance 1).
+    # Using the OIS approach, for dichotomous outcomes, one should consider rating down two levels for imprecision, when the ratio of the upper to the lower boundary of the CI is more than 2.5 for odds ratio or three for risk ratio;
+    # https://www.jclinepi.com/article/S0895-4356(22)00187-1/fulltext
+    # Unclear how to handle HR - handle like OR at the moment (i.e., cutoff 2.5)
+    final_sof_df["ci_very_wide"] = np.where(
+        final_sof_df["effect_type"] == "RR",
+        (final_sof_df["upper_ci"] / final_sof_df["lower_ci"]) > 3,
+        (final_sof_df["upper_ci"] / final_sof_df["lower_ci"]) > 2.5
     )
 
+    effect_sizes = list(effect_size_cutoffs.keys())
+    for i in range(len(effect_sizes)):
+        effect_size = effect_sizes[i]
+        if i == 0:
+            final_sof_df[effect_size] = (final_sof_df["point_estimate"] >= effect_size_cutoffs[effect_size]) | (final_sof_df["point_estimate"] <= (1/effect_size_cutoffs[effect_size]))
+        else:
+            final_sof_df[effect_size] = ((final_sof_df["point_estimate"] >= effect_size_cutoffs[effect_size]) & (final_sof_df["point_estimate"] < effect_size_cutoffs[effect_sizes[i-1]])) | \
+                                            ((final_sof_df["point_estimate"] > (1/effect_size_cutoffs[effect_sizes[i-1]])) & (final_sof_df["point_estimate"] <= (1/effect_size_cutoffs[effect_size])))
+    return final_sof_df
+
+certainty_cleaned_levels = ["very low", "low", "moderate", "high"]
+box_plot_measures = ["nr_participants_cleaned", "nr_studies_cleaned"]
+
+def histogram_box_stats(values, counts, label=None):
+    # Box plot statistics as from matplotlib.cbook.boxplot_stats(whis=0) (quartiles with linear interpolation, whiskers at the
+    # quartiles) of the sample in which each of the sorted, distinct values occurs counts times
+    n = counts.sum()
+    if not n:
+        return dict(label=label, med=np.nan, q1=np.nan, q3=np.nan, whislo=np.nan, whishi=np.nan, mean=np.nan, fliers=[])
+    ends = np.cumsum(counts)
+
+    def percentile(q):
+        position = q * (n - 1)
+        lower, upper = values[np.searchsorted(ends, [np.floor(position), np.ceil(position)], side="right")]
+        return lower + (upper - lower) * (position - np.floor(position))
+
+    q1, med, q3 = percentile(0.25), percentile(0.5), percentile(0.75)
+    return dict(label=label, med=med, q1=q1, q3=q3, whislo=q1, whishi=q3, mean=(values * counts).sum() / n, fliers=[])
+
+def certainty_stats(combined_sof_df):
+    # Input of create_box_pie_plot: per certainty level with outcomes, the number of outcomes and the box plot statistics of participants and studies
+    stats = {}
+    for level in certainty_cleaned_levels:
+        level_df = combined_sof_df[combined_sof_df["certainty_cleaned"] == level]
+        if len(level_df):
+            stats[level] = {"nr_outcomes": len(level_df)}
+            for measure in box_plot_measures:
+                stats[level][measure] = histogram_box_stats(*np.unique(level_df[measure].dropna().to_numpy(dtype=float), return_counts=True), level)
+    return stats
+
+class SortedOutcomeStats:
+    # certainty_stats of any selection of final_sof_df's outcomes (boolean mask over its rows, e.g. from the dashboard's outcome bitmaps):
+    # per certainty level and measure the outcomes are sorted by value once, a selection only picks its part of each sorted order
+    def __init__(self, final_sof_df):
+        certainty = final_sof_df["certainty_cleaned"].to_numpy(dtype=object)
+        self.levels = {}
+        for level in certainty_cleaned_levels:
+            positions = np.flatnonzero(certainty == level)
+            sorted_measures = {}
+            for measure in box_plot_measures:
+                values = final_sof_df[measure].to_numpy(dtype=float)[positions]
+                order = np.argsort(values, kind="stable")
+                order = order[~np.isnan(values[order])]
+                sorted_measures[measure] = (positions[order], values[order])
+            self.levels[level] = (positions, sorted_measures)
+
+    def stats(self, mask):
+        stats = {}
+        for level, (positions, sorted_measures) in self.levels.items():
+            nr_outcomes = mask[positions].sum()
+            if nr_outcomes:
+                stats[level] = {"nr_outcomes": int(nr_outcomes)}
+                for measure, (sorted_positions, sorted_values) in sorted_measures.items():
+                    stats[level][measure] = histogram_box_stats(*np.unique(sorted_values[mask[sorted_positions]], return_counts=True), level)
+        return stats
+
+# %%
+def create_box_pie_plot(combined_sof_df=None, showmeans=False, stats=None):
+    # Drawn from certainty_stats(combined_sof_df), or from precomputed stats (e.g. SortedOutcomeStats.stats); combined_sof_df is not modified
+    if stats is None:
+        stats = certainty_stats(combined_sof_df)
+    certainty_levels = list(stats)
+
     # Create box-plot
     fig, ax = plt.subplots(figsize=(5, 5))
-    data = [combined_sof_df.loc[combined_sof_df["certainty_cleaned"] == level, "nr_participants_cleaned"].dropna() for level in certainty_levels]
-    data_studies = [combined_sof_df.loc[combined_sof_df["certainty_cleaned"] == level, "nr_studies_cleaned"].dropna() for level in certainty_levels]
+    data = [stats[level]["nr_participants_cleaned"] for level in certainty_levels]
+    data_studies = [stats[level]["nr_studies_cleaned"] for level in certainty_levels]
 
     ax.set_ylabel('Number of participants', color='black')
     #ax.set_yscale('symlog')
     #ax.set_ylim(10, 100000)
     ax.set_ylim(0, 10000)
 
-    boxplot = ax.boxplot(
+    ax.bxp(
         data,
         positions=np.arange(len(certainty_levels)) * 2.0,  # Shift positions for the first set of boxplots
-        labels=certainty_levels,
         showfliers=False,
         meanline=True,
         showmeans=showmeans,
         patch_artist=True,
-        whis=0,
-        boxprops=dict(facecolor="white", color="black"),
+        boxprops=dict(facecolor="white", edgecolor="black"),
         medianprops=dict(color="black"),
         meanprops=dict(color="black", linestyle="--")
     )
@@ -335,15 +1330,14 @@ def create_box_pie_plot(combined_sof_df, showmeans=False):
     ax2.tick_params(axis='y', colors='grey')  # Set tick color to grey
     ax2.spines['right'].set_color('grey')  # Set the right spine color to grey
 
-    boxplot_studies = ax2.boxplot(
+    ax2.bxp(
         data_studies,
         positions=np.arange(len(certainty_levels)) * 2.0 + 0.8,  # Shift positions for the second set of boxplots
         showfliers=False,
         meanline=True,
         showmeans=showmeans,
         patch_artist=True,
-        whis=0,
-        boxprops=dict(facecolor="white", color="grey"),
+        boxprops=dict(facecolor="white", edgecolor="grey"),
         medianprops=dict(color="black"),
         whiskerprops=dict(color="grey"),
         capprops=dict(color="grey"),
@@ -358,10 +1352,8 @@ def create_box_pie_plot(combined_sof_df, showmeans=False):
     )
 
     # Add median values below x-labels for participants
-    for i, line in enumerate(boxplot['medians']):
-        median_value = line.get_ydata()[0]
-        p25 = boxplot['whiskers'][i*2].get_ydata()[0]
-        p75 = boxplot['whiskers'][i*2+1].get_ydata()[0]
+    for i, level_stats in enumerate(data):
+        median_value, p25, p75 = level_stats["med"], level_stats["q1"], level_stats["q3"]
         ax.text(
             i * 2.0 + 0.5,  # x-coordinate (boxplot positions are 1-indexed)
             -700,  # y-coordinate (below the x-axis)
@@ -370,10 +1362,8 @@ def create_box_pie_plot(combined_sof_df, showmeans=False):
         )
 
     # # Add median values below x-labels for studies
-    for i, line in enumerate(boxplot_studies['medians']):
-        median_value = line.get_ydata()[0]
-        p25 = boxplot_studies['whiskers'][i*2].get_ydata()[0]
-        p75 = boxplot_studies['whiskers'][i*2+1].get_ydata()[0]
+    for i, level_stats in enumerate(data_studies):
+        median_value, p25, p75 = level_stats["med"], level_stats["q1"], level_stats["q3"]
         ax.text(
             i * 2.0 + 0.7,  # x-coordinate (boxplot positions are 1-indexed)
             -700,  # y-coordinate (below the x-axis)
@@ -389,7 +1379,7 @@ def create_box_pie_plot(combined_sof_df, showmeans=False):
     fig.suptitle('')
 
     # Add pie chart as inset
-    plot_df = pd.DataFrame(combined_sof_df["certainty_cleaned"].value_counts(sort=False)).reset_index()
+    plot_df = pd.DataFrame({"certainty_cleaned": certainty_levels, "count": [stats[level]["nr_outcomes"] for level in certainty_levels]})
 
     pie_ax_pos = [0.27, 0.53, 0.3, 0.3]  # [left, bottom, width, height]
     inset_ax = fig.add_axes(pie_ax_pos)
@@ -399,4 +1389,28 @@ def create_box_pie_plot(combined_sof_df, showmeans=False):
                                            colors=colors[::-1], autopct='%.0f%%', startangle=90, pctdistance=0.75)
     inset_ax.axis('equal')
     return fig, ax, ax2, inset_ax
+
+box_pie_plot_cache = LRUMemo(maxsize=256)
+box_pie_plot_cache_lock = threading.Lock()
+
+def stats_fingerprint(stats, showmeans=False, format="png"):
+    # Key of a rendered plot: everything create_box_pie_plot draws from stats (equal statistics of different selections share the image)
+    keys = ["q1", "med", "q3", "whislo", "whishi", "mean"]
+    parts = [f"{format} {showmeans}"] + [f"{level} {level_stats['nr_outcomes']} " + " ".join(f"{level_stats[measure][key]!r}" for measure in box_plot_measures for key in keys) for level, level_stats in stats.items()]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+def render_box_pie_plot(stats, showmeans=False, format="png", dpi=200, cache=box_pie_plot_cache):
+    # create_box_pie_plot(stats=stats) as image bytes (as st.pyplot saves it), cached by stats_fingerprint (LRU, shared by all dashboard sessions)
+    key = stats_fingerprint(stats, showmeans, format)
+    with box_pie_plot_cache_lock:
+        image = cache.get(key)
+    if image is None:
+        fig = create_box_pie_plot(showmeans=showmeans, stats=stats)[0]
+        buffer = BytesIO()
+        fig.savefig(buffer, format=format, dpi=dpi, bbox_inches="tight")
+        plt.close(fig)
+        image = buffer.getvalue()
+        with box_pie_plot_cache_lock:
+            cache[key] = image
+    return image
 # %%